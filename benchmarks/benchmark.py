@@ -0,0 +1,391 @@
+"""
+Benchmarks for the descriptor generation of pes/exercise_2 and the avatar streaming path of vr/rendering.
+
+All the data is synthetic: molecules with the CH4CN atom pattern (C, H, H, H, H, C, N, repeated for larger molecules)
+and random frames for the avatar. Every benchmark is run a few times and the results are written as json, e.g.
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --samples 1000 1000000 --atoms 7 50 --max-bytes 4e9
+    python benchmarks/benchmark.py --quick --only descriptors
+
+Each result has the name and parameters of the benchmark, the duration of every run, the latency percentiles (of a
+run, or of a single frame for the per-frame avatar benchmarks), the throughput in items (samples or frames) per
+second, and the peak memory allocated during one run, as traced by tracemalloc (numpy arrays included). The float32
+results of the precision group also hold the errors of the float32 descriptors against the float64 ones.
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "pes", "exercise_2"))
+sys.path.insert(0, os.path.join(ROOT, "vr", "rendering"))
+
+import pre_processing  # noqa: E402
+import AvatarServer  # noqa: E402
+
+CH4CN_LABELS = ["C", "H", "H", "H", "H", "C", "N"]
+FEATURES = ['LController', 'RController', 'Headset']
+TARGETS = ['Front', 'Back', 'LeftElbow', 'RightElbow', 'LeftKnee', 'RightKnee']
+
+
+def percentiles(times):
+    """
+    :param times: Durations in seconds.
+    :return: Dictionary of the 50th, 90th and 99th percentiles and the mean, in seconds.
+    """
+    times = np.asarray(times)
+    return {"p50": float(np.percentile(times, 50)), "p90": float(np.percentile(times, 90)),
+            "p99": float(np.percentile(times, 99)), "mean": float(times.mean())}
+
+
+def peak_memory(func):
+    """
+    Runs a function once while tracing the memory allocations.
+    :param func: Function without arguments.
+    :return: The peak memory allocated in bytes.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(name, func, n_items, repeats, params, unit="samples"):
+    """
+    Times repeated runs of a function. The memory traced run comes first and also serves as a warm up.
+
+    :param name: Name of the benchmark.
+    :param func: Function without arguments running the benchmark once.
+    :param n_items: Number of items (samples or frames) processed by one run.
+    :param repeats: Number of timed runs.
+    :param params: Parameters of the benchmark, copied to the result.
+    :param unit: Name of the items.
+    :return: The result dictionary.
+    """
+    peak = peak_memory(func)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    result = {"name": name, "params": params, "times": times, "latency": percentiles(times),
+              "throughput": n_items / float(np.median(times)), "unit": unit + "/s", "peak_memory": peak}
+    print("%-32s %-40s %12.1f %s  %8.1f MB" % (name, json.dumps(params, sort_keys=True), result["throughput"],
+                                                result["unit"], peak / 2.0**20))
+    return result
+
+
+def skipped(name, params, reason):
+    """
+    :return: The result of a benchmark that was not run.
+    """
+    print("%-32s %-40s skipped: %s" % (name, json.dumps(params, sort_keys=True), reason))
+    return {"name": name, "params": params, "skipped": reason}
+
+
+def synthetic_geometries(n_samples, n_atoms, seed=0):
+    """
+    Generates random geometries with well separated atoms.
+    :param n_samples: Number of samples.
+    :param n_atoms: Number of atoms per sample, the labels follow the CH4CN pattern.
+    :param seed: Seed of the random generator.
+    :return: GeometrySet.
+    """
+    rng = np.random.RandomState(seed)
+    labels = (CH4CN_LABELS * (n_atoms // len(CH4CN_LABELS) + 1))[:n_atoms]
+    # Atoms on a grid 1.5 Angstrom apart, moved by up to 0.3 Angstrom in every sample
+    side = int(np.ceil(n_atoms ** (1.0 / 3)))
+    grid = np.stack(np.meshgrid(*[np.arange(side)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)[:n_atoms] * 1.5
+    coords = grid + rng.uniform(-0.3, 0.3, size=(n_samples, n_atoms, 3))
+    return pre_processing.GeometrySet(coords, labels)
+
+
+def descriptor_bytes(n_samples, n_atoms, num_rep):
+    """
+    :return: Rough estimate of the memory used by the largest descriptor benchmark, in bytes.
+    """
+    return 8 * n_samples * n_atoms ** 2 * (2 + num_rep)
+
+
+def benchmark_descriptors(samples, atoms, repeats, num_rep, max_bytes):
+    """
+    Benchmarks the construction of CoulombMatrix and its generate methods.
+    """
+    results = []
+    for n_atoms in atoms:
+        for n_samples in samples:
+            params = {"n_samples": n_samples, "n_atoms": n_atoms}
+            if descriptor_bytes(n_samples, n_atoms, num_rep) > max_bytes:
+                results.append(skipped("descriptors", params, "needs more than --max-bytes"))
+                continue
+
+            geometries = synthetic_geometries(n_samples, n_atoms)
+            y = np.random.RandomState(1).uniform(size=n_samples)
+            results.append(measure("CoulombMatrix", lambda: pre_processing.CoulombMatrix(geometries), n_samples,
+                                   repeats, params))
+            results.append(measure("CoulombMatrix(packed)",
+                                   lambda: pre_processing.CoulombMatrix(geometries, packed=True), n_samples, repeats,
+                                   params))
+
+            cm = pre_processing.CoulombMatrix(geometries)
+            results.append(measure("generateES", cm.generateES, n_samples, repeats, params))
+            results.append(measure("generateSCM", cm.generateSCM, n_samples, repeats, params))
+            results.append(measure("generateTriangCM", cm.generateTriangCM, n_samples, repeats, params))
+            results.append(measure("generateRSCM", lambda: cm.generateRSCM(y, numRep=num_rep), n_samples, repeats,
+                                   dict(params, numRep=num_rep)))
+            results.append(measure("generatePRCM", lambda: cm.generatePRCM(y, numRep=2), n_samples, repeats,
+                                   dict(params, numRep=2)))
+            del cm
+    return results
+
+
+def benchmark_precision(samples, atoms, repeats, num_rep, max_bytes):
+    """
+    Benchmarks the float32 descriptor pipeline against the float64 one: CoulombMatrix followed by generateDescriptors
+    for TriangCM, SCM, ES and RSCM, and the accuracy of the float32 descriptors (compareDtypes), stored with the float32
+    results.
+    """
+    results = []
+    for n_atoms in atoms:
+        for n_samples in samples:
+            params = {"n_samples": n_samples, "n_atoms": n_atoms, "numRep": num_rep}
+            if descriptor_bytes(n_samples, n_atoms, num_rep) > max_bytes:
+                results.append(skipped("precision", params, "needs more than --max-bytes"))
+                continue
+
+            geometries = synthetic_geometries(n_samples, n_atoms)
+            for dtype in (np.float64, np.float32):
+                def run():
+                    cm = pre_processing.CoulombMatrix(geometries, dtype=dtype)
+                    cm.generateDescriptors(["TriangCM", "SCM", "ES", "RSCM"], numRep=num_rep)
+                results.append(measure("descriptors(%s)" % np.dtype(dtype).name, run, n_samples, repeats, params))
+            results[-1]["errors"] = pre_processing.compareDtypes(geometries, dtype=np.float32)
+    return results
+
+
+def write_data_csv(file_name, geometries, rng):
+    """
+    Writes a data set in the format read by loadData: an index column, the coordinates, the partial charges and the
+    two energies.
+    """
+    n_samples, n_atoms = geometries.n_samples, geometries.n_atoms
+    table = np.hstack([np.arange(n_samples)[:, None], geometries.coords.reshape(n_samples, -1),
+                       rng.uniform(-1, 1, size=(n_samples, n_atoms)), rng.uniform(-100, -99, size=(n_samples, 2))])
+    header = [""] + ["%s%d%s" % (label, i + 1, c) for i, label in enumerate(geometries.labels) for c in "xyz"]
+    header += ["q%d" % (i + 1) for i in range(n_atoms)] + ["E1", "E2"]
+    np.savetxt(file_name, table, delimiter=",", header=",".join(header), comments="", fmt="%.8g")
+
+
+def write_x_csv(file_name, geometries):
+    """
+    Writes geometries in the format read by loadX: "C,0.1,0.1,0.1,H,0.2,0.2,0.2,...".
+    """
+    with open(file_name, "w") as csv_file:
+        for sample in geometries.coords:
+            csv_file.write(",".join("%s,%.8g,%.8g,%.8g" % ((label,) + tuple(xyz))
+                                    for label, xyz in zip(geometries.labels, sample)) + "\n")
+
+
+def benchmark_loaders(samples, repeats, max_bytes):
+    """
+    Benchmarks loadData, loadX and loadY on synthetic CH4CN files, parsing the text (cold) and reading the binary cache
+    (warm).
+    """
+    results = []
+    rng = np.random.RandomState(2)
+    directory = tempfile.mkdtemp()
+    for n_samples in samples:
+        params = {"n_samples": n_samples, "n_atoms": len(CH4CN_LABELS)}
+        # The text files and their parsing take about 20 times the memory of the arrays
+        if 20 * 8 * n_samples * 31 > max_bytes:
+            results.append(skipped("loaders", params, "needs more than --max-bytes"))
+            continue
+
+        geometries = synthetic_geometries(n_samples, len(CH4CN_LABELS))
+        data_file = os.path.join(directory, "data_%d.csv" % n_samples)
+        x_file = os.path.join(directory, "x_%d.csv" % n_samples)
+        y_file = os.path.join(directory, "y_%d.csv" % n_samples)
+        write_data_csv(data_file, geometries, rng)
+        write_x_csv(x_file, geometries)
+        np.savetxt(y_file, rng.uniform(size=n_samples), fmt="%.8g")
+
+        for use_cache in (False, True):
+            cached = dict(params, useCache=use_cache)
+            results.append(measure("loadData", lambda: pre_processing.loadData(data_file, useCache=use_cache),
+                                   n_samples, repeats, cached))
+            results.append(measure("loadData(columnar)",
+                                   lambda: pre_processing.loadData(data_file, columnar=True, useCache=use_cache),
+                                   n_samples, repeats, cached))
+            results.append(measure("loadX", lambda: pre_processing.loadX(x_file, useCache=use_cache), n_samples,
+                                   repeats, cached))
+            results.append(measure("loadY", lambda: pre_processing.loadY(y_file, useCache=use_cache), n_samples,
+                                   repeats, cached))
+
+        for file_name in (data_file, x_file, y_file):
+            for name in (file_name, file_name + ".cache.npz"):
+                if os.path.exists(name):
+                    os.remove(name)
+    os.rmdir(directory)
+    return results
+
+
+class LoopbackSink:
+    """
+    Client of an AvatarServer on localhost that reads and discards everything it receives, on a background thread.
+    """
+
+    def __init__(self, port, handshake=b""):
+        self.received = 0
+        self.socket = socket.create_connection(("localhost", port))
+        if handshake:
+            self.socket.sendall(handshake)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.socket.recv(1 << 20)
+            if not data:
+                break
+            self.received += len(data)
+        self.socket.close()
+
+
+def connect_sink(server, protocol):
+    """
+    Connects a LoopbackSink speaking a protocol to the server.
+    :return: The sink.
+    """
+    handshake = {"json": b"", "binary": AvatarServer.BINARY_HANDSHAKE,
+                 "delta": AvatarServer.DELTA_HANDSHAKE}[protocol]
+    sink = LoopbackSink(server.port, handshake)
+    server.connect_to_client()
+    return sink
+
+
+def benchmark_avatar(n_frames, repeats):
+    """
+    Benchmarks the encoding of frames and sending them to a loopback client, for every protocol.
+    """
+    results = []
+    labels = AvatarServer.generate_labels_full(FEATURES, TARGETS)
+    rng = np.random.RandomState(3)
+    features = rng.uniform(-1, 1, size=(n_frames, 3 * len(FEATURES)))
+    targets = rng.uniform(-1, 1, size=(n_frames, 3 * len(TARGETS)))
+    predictions = targets + rng.normal(scale=0.01, size=targets.shape)
+    encoder = AvatarServer.FrameEncoder(*labels)
+    params = {"n_frames": n_frames}
+
+    results.append(measure("generate_message", lambda: [AvatarServer.generate_message(f, labels[0], t, labels[1], p,
+                                                                                      labels[2])
+                                                         for f, t, p in zip(features, targets, predictions)],
+                           n_frames, repeats, params, unit="frames"))
+    for protocol in ("json", "binary"):
+        results.append(measure("FrameEncoder.encode_batch",
+                               lambda: encoder.encode_batch(features, targets, predictions, protocol=protocol),
+                               n_frames, repeats, dict(params, protocol=protocol), unit="frames"))
+
+    # Any free port, so that a renderer or another server on the default port is left alone
+    server = AvatarServer.AvatarServer(port=0)
+    server.port = server.socket.getsockname()[1]
+
+    for protocol in ("json", "binary", "delta"):
+        sink = connect_sink(server, protocol)
+        protocol_params = dict(params, protocol=protocol)
+
+        # Per frame latency of send_frame, after a memory traced run as in measure
+        def send_frames(latencies):
+            for f, t, p in zip(features, targets, predictions):
+                start = time.perf_counter()
+                server.send_frame(encoder, f, t, p)
+                latencies.append(time.perf_counter() - start)
+
+        peak = peak_memory(lambda: send_frames([]))
+        latencies = []
+        send_frames(latencies)
+        result = {"name": "send_frame", "params": protocol_params, "times": [float(np.sum(latencies))],
+                  "latency": percentiles(latencies), "throughput": n_frames / float(np.sum(latencies)),
+                  "unit": "frames/s", "peak_memory": peak}
+        print("%-32s %-40s %12.1f %s  %8.1f MB" % (result["name"], json.dumps(protocol_params, sort_keys=True),
+                                                    result["throughput"], result["unit"], peak / 2.0**20))
+        results.append(result)
+
+        results.append(measure("stream_data_to_render",
+                               lambda: AvatarServer.stream_data_to_render(server, features, targets, predictions,
+                                                                          *labels, fps=None),
+                               n_frames, repeats, protocol_params, unit="frames"))
+        server.close_connection()
+        sink.thread.join()
+        # The two runs of send_frame, then the memory traced run and the timed runs of stream_data_to_render
+        results[-1]["bytes_per_frame"] = sink.received / float(n_frames * (repeats + 3))
+    server.socket.close()
+    return results
+
+
+def metadata():
+    """
+    :return: Description of the machine and of the version of the code that ran the benchmarks.
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL)
+        commit = commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "python": platform.python_version(),
+            "numpy": np.__version__, "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="benchmark_results.json", help="json file to write the results to")
+    parser.add_argument("--samples", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="numbers of samples of the descriptor and loader benchmarks")
+    parser.add_argument("--atoms", type=int, nargs="+", default=[7, 20, 50],
+                        help="numbers of atoms per sample of the descriptor benchmarks")
+    parser.add_argument("--frames", type=int, default=10000, help="number of frames of the avatar benchmarks")
+    parser.add_argument("--repeats", type=int, default=5, help="number of timed runs of every benchmark")
+    parser.add_argument("--num-rep", type=int, default=5, help="numRep of generateRSCM")
+    parser.add_argument("--max-bytes", type=float, default=2e9,
+                        help="skip the sizes that would need more memory than this, in bytes")
+    parser.add_argument("--only", choices=["descriptors", "precision", "loaders", "avatar"], nargs="+",
+                        help="run only these groups of benchmarks")
+    parser.add_argument("--quick", action="store_true",
+                        help="small sizes and 3 runs, to check that everything works")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.samples, args.atoms, args.frames, args.repeats = [1000, 10000], [7, 20], 2000, 3
+    groups = args.only or ["descriptors", "precision", "loaders", "avatar"]
+
+    results = []
+    if "descriptors" in groups:
+        results += benchmark_descriptors(args.samples, args.atoms, args.repeats, args.num_rep, args.max_bytes)
+    if "precision" in groups:
+        results += benchmark_precision(args.samples, args.atoms, args.repeats, args.num_rep, args.max_bytes)
+    if "loaders" in groups:
+        results += benchmark_loaders(args.samples, args.repeats, args.max_bytes)
+    if "avatar" in groups:
+        results += benchmark_avatar(args.frames, args.repeats)
+
+    with open(args.output, "w") as output_file:
+        json.dump({"metadata": metadata(), "results": results}, output_file, indent=1)
+    print("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
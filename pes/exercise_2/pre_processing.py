@@ -1,71 +1,182 @@
+import os
+import collections
+import hashlib
+import itertools
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 from numpy import linalg as LA
 from scipy.special import factorial
 
+# Symbols of the elements, in order of atomic number
+elementSymbols = ['H', 'He',
+                  'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne',
+                  'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar',
+                  'K', 'Ca', 'Sc', 'Ti', 'V', 'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'As', 'Se', 'Br',
+                  'Kr',
+                  'Rb', 'Sr', 'Y', 'Zr', 'Nb', 'Mo', 'Tc', 'Ru', 'Rh', 'Pd', 'Ag', 'Cd', 'In', 'Sn', 'Sb', 'Te', 'I',
+                  'Xe',
+                  'Cs', 'Ba', 'La', 'Ce', 'Pr', 'Nd', 'Pm', 'Sm', 'Eu', 'Gd', 'Tb', 'Dy', 'Ho', 'Er', 'Tm', 'Yb',
+                  'Lu', 'Hf', 'Ta', 'W', 'Re', 'Os', 'Ir', 'Pt', 'Au', 'Hg', 'Tl', 'Pb', 'Bi', 'Po', 'At', 'Rn',
+                  'Fr', 'Ra', 'Ac', 'Th', 'Pa', 'U', 'Np', 'Pu', 'Am', 'Cm', 'Bk', 'Cf', 'Es', 'Fm', 'Md', 'No',
+                  'Lr', 'Rf', 'Db', 'Sg', 'Bh', 'Hs', 'Mt', 'Ds', 'Rg', 'Cn', 'Nh', 'Fl', 'Mc', 'Lv', 'Ts', 'Og']
+
+# Nuclear charges of the atoms that can appear in the data sets
+atomicCharges = {symbol: float(i + 1) for i, symbol in enumerate(elementSymbols)}
+
+def tableKey(fileName, skipRows=0, useCols=None):
+    """
+    This function returns the key that a binary sidecar file must hold to be up to date with a .csv file: its size, its
+    modification time, and the lines and columns that were read.
 
-def loadData(fileName):
+    :fileName: .csv file (string)
+    :skipRows: number of header lines skipped (int)
+    :useCols: indexes of the columns read, all of them if None (list of int)
+    :return: numpy array of int
     """
-    This function takes a .csv file generated after processing the original CSV files with the package PANDAS.
-    The data is arranged with first the geometries in a 'clean datases' arrangement. This means that the headers tell
-    the atom label for each coordinate. For example, for a molecule with 3 hydrogens, the first two lines of the csv
-    file for the geometries look like:
+    fileStat = os.stat(fileName)
+    return np.array([fileStat.st_size, fileStat.st_mtime_ns, skipRows] + (list(useCols) if useCols is not None else []))
 
-    ``H1x, H1y, H1z, H2x, H2y, H2z, H3x, H3y, H3z
-    0,1.350508,0.7790238,0.6630868,1.825709,1.257877,-0.1891705,1.848891,1.089646``
+def cachedTable(fileName, skipRows=0):
+    """
+    This function reads back the binary sidecar file written by loadTable, whatever the columns that were read, if it is
+    up to date with the .csv file.
 
-    Then there are the partial charges and then 2 values of the energies (all in similar format to the geometries).
+    :fileName: .csv file (string)
+    :skipRows: number of header lines skipped (int)
+    :return: dictionary with the "table", its "key" and the extra arrays saved with it, or None if there is no up to date
+        sidecar file
+    """
+    cacheName = fileName + ".cache.npz"
+    if not os.path.isfile(cacheName):
+        return None
+    key = tableKey(fileName, skipRows)
+    with np.load(cacheName) as cache:
+        if cache["key"].shape[0] < key.shape[0] or not np.array_equal(cache["key"][:key.shape[0]], key):
+            return None
+        return {name: cache[name] for name in cache.files}
+
+def loadTable(fileName, skipRows=0, useCols=None, useCache=True, extra=None):
+    """
+    This function reads all the numerical columns of a .csv file in one go with numpy. The parsed table is also saved in
+    a binary sidecar file (fileName + '.cache.npz') together with the size and modification time of the .csv file. The
+    next time the same file is loaded the table is read back from the sidecar instead of parsing the text again, unless
+    the .csv file has changed since.
+
+    :fileName: .csv file (string)
+    :skipRows: number of header lines to skip (int)
+    :useCols: indexes of the columns to read, all of them if None (list of int)
+    :useCache: whether to read/write the binary sidecar file (bool)
+    :extra: other arrays to save in the sidecar file with the table, read back by cachedTable (dict of numpy arrays)
+    :return: numpy array of shape (n_lines, n_columns)
+    """
+    cacheName = fileName + ".cache.npz"
+    key = tableKey(fileName, skipRows, useCols)
+
+    if useCache and os.path.isfile(cacheName):
+        with np.load(cacheName) as cache:
+            # A sidecar file written without the extra arrays is written again with them
+            if np.array_equal(cache["key"], key) and all(name in cache.files for name in (extra or {})):
+                return cache["table"]
+
+    table = np.loadtxt(fileName, delimiter=",", skiprows=skipRows, usecols=useCols, ndmin=2)
+
+    if useCache:
+        # Writing to a temporary file first so that an interrupted run never leaves a broken cache behind
+        try:
+            with open(cacheName + ".tmp", "wb") as cacheFile:
+                np.savez(cacheFile, key=key, table=table, **(extra or {}))
+            os.replace(cacheName + ".tmp", cacheName)
+        except OSError:
+            pass
 
-    **Note**: This is specific to the CH4CN system!
+    return table
+
+# Atoms of the CH4CN data sets, in the order of the columns
+CH4CNLabels = ["C","H","H","H","H","C","N"]
+
+def loadDataArrays(fileName, useCache=True, atomLabels=None):
+    """
+    This function reads a .csv file in the format described in loadData and returns the geometries, the partial charges
+    and the energy differences as numpy arrays, parsing the whole file in one pass (see loadTable for the caching).
 
     :fileName: .csv file (string)
+    :useCache: whether to use the binary sidecar cache (bool)
+    :atomLabels: labels of the atoms of the molecule, in the order of the columns (list of strings). Defaults to the
+        CH4CN atoms ["C","H","H","H","H","C","N"].
 
     :return:
-    :matrixX: a list of lists with characters and floats.
+    :geometries: a GeometrySet with the coordinates of shape (n_samples, n_atoms, 3)
     :matrixY: a numpy array of energy differences (floats) of size (n_samples,)
-    :matrixQ: a list of numpy arrays of the partial charges -  size (n_samples, n_atoms)
+    :matrixQ: a numpy array of the partial charges of size (n_samples, n_atoms)
     """
 
     if fileName[-4:] != ".csv":
         raise ValueError("Error: the file extension is not .csv")
 
-    inputFile = open(fileName, 'r')
-    isFirstLine = True
+    # The first column is the index written by PANDAS, which is not needed
+    with open(fileName, 'r') as inputFile:
+        n_columns = len(inputFile.readline().split(","))
 
-    # Lists that will contain the data
-    matrixX = []
-    matrixY = []
-    matrixQ = []
+    atomLabels = CH4CNLabels if atomLabels is None else list(atomLabels)
+    n_coords = 3 * len(atomLabels)
+    # The coordinates and the partial charge of each atom, then the two energies
+    if n_columns - 1 != 4 * len(atomLabels) + 2:
+        raise ValueError("Error: %s has %d columns, %d were expected for %d atoms." %
+                         (fileName, n_columns - 1, 4 * len(atomLabels) + 2, len(atomLabels)))
+
+    table = loadTable(fileName, skipRows=1, useCols=range(1, n_columns), useCache=useCache)
 
-    # Reading the file
-    for line in inputFile:
-        if isFirstLine:
-            line = next(inputFile)
-            isFirstLine = False
+    geometries = GeometrySet(table[:, 0:n_coords], atomLabels)
+    matrixQ = table[:, n_coords:-2]
+    matrixY = table[:, -1] - table[:, -2]
 
-        line = line.replace("\n", "")
-        listLine = line.split(",")
+    return geometries, matrixY, matrixQ
 
-        geom = extractGeom(listLine)
-        eneDiff = extractEneDiff(listLine)
-        partQ = extractQ(listLine)
+def loadData(fileName, columnar=False, useCache=True, atomLabels=None):
+    """
+    This function takes a .csv file generated after processing the original CSV files with the package PANDAS.
+    The data is arranged with first the geometries in a 'clean datases' arrangement. This means that the headers tell
+    the atom label for each coordinate. For example, for a molecule with 3 hydrogens, the first two lines of the csv
+    file for the geometries look like:
 
-        matrixX.append(geom)
-        matrixY.append(eneDiff)
-        matrixQ.append(partQ)
+    ``H1x, H1y, H1z, H2x, H2y, H2z, H3x, H3y, H3z
+    0,1.350508,0.7790238,0.6630868,1.825709,1.257877,-0.1891705,1.848891,1.089646``
 
-    matrixY = np.asarray(matrixY)
+    Then there are the partial charges and then 2 values of the energies (all in similar format to the geometries).
+    Use loadDataArrays to also get the partial charges.
 
-    return matrixX, matrixY
+    :fileName: .csv file (string)
+    :columnar: if True the geometries are returned as a GeometrySet instead of a list of lists (bool)
+    :useCache: whether to use the binary sidecar cache (see loadTable) (bool)
+    :atomLabels: labels of the atoms of the molecule, in the order of the columns (list of strings). Defaults to the
+        CH4CN atoms ["C","H","H","H","H","C","N"].
 
-def extractGeom(lineList):
+    :return:
+    :matrixX: a list of lists with characters and floats (or a GeometrySet if columnar is True).
+    :matrixY: a numpy array of energy differences (floats) of size (n_samples,)
     """
-    Function used by loadPd_q to extract the geometries.
+
+    geometries, matrixY, matrixQ = loadDataArrays(fileName, useCache=useCache, atomLabels=atomLabels)
+
+    if columnar:
+        return geometries, matrixY
+
+    return geometries.toList(), matrixY
+
+def extractGeom(lineList, atomLabels=None):
+    """
+    This function extracts the geometry from a line of the clean data set (see loadData).
 
     :lineList: line with geometries in clean format, partial charges and energies
-    :return: list of geometry in format [['H',-0.5,0.0,0.0,'H',0.5,0.0,0.0], ['H',-0.3,0.0,0.0,'H',0.3,0.0,0.0]...
+    :atomLabels: labels of the atoms of the molecule, in the order of the columns (list of strings). Defaults to the
+        CH4CN atoms ["C","H","H","H","H","C","N"].
+    :return: list of geometry in format ['H',-0.5,0.0,0.0,'H',0.5,0.0,0.0]
     """
-    geomPart = lineList[1:22]
-    atomLab = ["C","H","H","H","H","C","N"]
+    atomLab = CH4CNLabels if atomLabels is None else list(atomLabels)
+    geomPart = lineList[1:1 + 3*len(atomLab)]
     finalGeom = []
 
     for i in range(len(atomLab)):
@@ -77,7 +188,7 @@ def extractGeom(lineList):
 
 def extractEneDiff(lineList):
     """
-    This function is used by loadPd_q  to extract the energy from a line of the clean data set.
+    This function extracts the energy difference from a line of the clean data set (see loadData).
 
     :param lineList: line with geometries in clean format, partial charges and energies
     :return: energy difference (float)
@@ -86,23 +197,20 @@ def extractEneDiff(lineList):
     eneDiff = float(enePart[1]) - float(enePart[0])
     return eneDiff
 
-def extractQ(lineList):
+def extractQ(lineList, atomLabels=None):
     """
-    This function is used by loadPd_q to extract the partial charges from a line of the clean data set.
+    This function extracts the partial charges from a line of the clean data set (see loadData).
 
     :lineList: line with geometries in clean format, partial charges and energies
+    :atomLabels: labels of the atoms of the molecule, in the order of the columns (list of strings). Defaults to the
+        CH4CN atoms ["C","H","H","H","H","C","N"].
     :return: numpy array of partial charges of size (n_atoms)
     """
-    qPart = lineList[22:-2]
-    for i in range(len(qPart)):
-        qPart[i] = float(qPart[i])
-
-    qPart = np.asarray(qPart)
-    return qPart
-
+    atomLab = CH4CNLabels if atomLabels is None else list(atomLabels)
+    qPart = lineList[1 + 3*len(atomLab):-2]
+    return np.asarray([float(q) for q in qPart])
 
-
-def loadX(fileX):
+def loadX(fileX, columnar=False, useCache=True):
     """
     This function takes a .csv file that contains on each line a different configuration of the system in the format
         "C,0.1,0.1,0.1,H,0.2,0.2,0.2..." and returns a list of lists with the configurations of the system.
@@ -117,57 +225,503 @@ def loadX(fileX):
         for a sample with 3 hydrogen atoms the matrix returned will be:
         ``[['H',-0.5,0.0,0.0,'H',0.5,0.0,0.0], ['H',-0.3,0.0,0.0,'H',0.3,0.0,0.0], ['H',-0.7,0.0,0.0,'H',0.7,0.0,0.0]]``
         
+        With columnar=True the geometries are returned as a GeometrySet instead, or as a PaddedGeometrySet if the lines
+        do not all have the same atoms in the same order.
+
+        When all the lines have the same atoms in the same order, the coordinates are parsed in one go by loadTable and
+        cached together with the atom labels, so that the text is not read at all the next time. Otherwise each line is
+        parsed on its own, with its own atom labels.
+
         :fileX: The .csv file containing the geometries of the system (string)
-        :return: a list of lists with characters and floats.
+        :columnar: if True a GeometrySet is returned instead of a list of lists (bool)
+        :useCache: whether to use the binary sidecar cache (see loadTable) (bool)
+        :return: a list of lists with characters and floats (or a GeometrySet if columnar is True).
     """
     
     if fileX[-4:] != ".csv":
         raise  ValueError("Error: the file extension is not .csv")
 
-    inputFile = open(fileX, 'r')
-
-    # Creating an empty matrix of the right size
+    cache = cachedTable(fileX) if useCache else None
+    if cache is not None and "labels" in cache:
+        matrixX = GeometrySet(cache["table"], cache["labels"].tolist())
+        if columnar:
+            return matrixX
+        return matrixX.toList()
+
+    with open(fileX, 'r') as inputFile:
+        lines = [line.replace(",\n","").replace("\n","").split(",") for line in inputFile if line.strip()]
+
+    # The bulk parser needs every line to have the atoms of the first one, in the same order
+    labels = lines[0][0::4] if lines else []
+    if lines and all(len(listLine) == len(lines[0]) and listLine[0::4] == labels for listLine in lines):
+        coordCols = [i for i in range(len(labels) * 4) if i % 4 != 0]
+        table = loadTable(fileX, useCols=coordCols, useCache=useCache, extra={"labels": np.array(labels)})
+        matrixX = GeometrySet(table, labels)
+        if columnar:
+            return matrixX
+        return matrixX.toList()
+
+    # Lines with different atoms: converting the numbers to float line by line
     matrixX = []
-    
-    for line in inputFile:
-        
-        line = line.replace(",\n","")
-        listLine = line.split(",")
-        
-        # converting the numbers to float
-        for i in range(0,len(listLine)-1,4):
+    for listLine in lines:
+        for i in range(0, len(listLine)-1, 4):
             for j in range(3):
                 listLine[i+j+1] = float(listLine[i+j+1])
         matrixX.append(listLine)
-    
-    inputFile.close()
+
+    if columnar:
+        return PaddedGeometrySet.fromList(matrixX)
+
     return matrixX
 
-def loadY(fileY):
+def loadY(fileY, useCache=True):
     """
         This function takes a .csv file containing the energies of a system and returns an array with the energies contained
         in the file.
         
         :fileY: the .csv file containing the energies of the system (string)
+        :useCache: whether to use the binary sidecar cache (see loadTable) (bool)
         :return: numpy array of shape (n_samples, 1)
     """
     
     # Checking that the input file has the correct .csv extension
     if fileY[-4:] != ".csv":
         raise ValueError("Error: the file extension is not .csv")
-    
-    inputFile = open(fileY, 'r')
 
-    y_list = []
-    for line in inputFile:
-        y_list.append(float(line))
+    matrixY = loadTable(fileY, useCache=useCache).reshape((-1, 1))
 
-    matrixY = np.asarray(y_list).reshape((len(y_list), 1))
-    
-    inputFile.close()
     return matrixY
 
 
+class GeometrySet():
+    """
+    This class is a compact container for the geometries of a data set where all the samples have the same atoms in the
+    same order (like the CH4CN data). Instead of one list per sample it stores:
+
+    1. coords: one numpy array of shape (n_samples, n_atoms, 3) with the xyz coordinates
+    2. labels: one numpy array of shape (n_atoms,) with the atom labels, shared by all the samples
+    3. charges: one numpy array of shape (n_atoms,) with the matching nuclear charges
+
+    Indexing it with a slice returns a new GeometrySet whose coordinates are a view on the original array, so taking
+    train/test splits or mini-batches does not copy any data.
+
+    :coords: array-like of shape (n_samples, n_atoms, 3) or (n_samples, 3*n_atoms)
+    :labels: list of the atom labels of length n_atoms, e.g. ['C', 'H', 'H', 'H', 'H', 'C', 'N']
+    """
+
+    def __init__(self, coords, labels):
+
+        self.labels = np.asarray(labels)
+        self.n_atoms = len(self.labels)
+        self.coords = np.reshape(np.asarray(coords, dtype=float), (-1, self.n_atoms, 3))
+        self.n_samples = self.coords.shape[0]
+        self.charges = np.array([atomicCharges[label] for label in self.labels])
+
+    @classmethod
+    def fromList(cls, matrixX):
+        """
+        This function builds a GeometrySet from a list of lists in the format returned by loadX.
+
+        :matrixX: list of lists, for example [['H',-0.5,0.0,0.0,'H',0.5,0.0,0.0], ['H',-0.3,0.0,0.0,'H',0.3,0.0,0.0]]
+        :return: GeometrySet
+        """
+        n_atoms = int(len(matrixX[0])/4)
+        rawArray = np.asarray(matrixX, dtype=object).reshape((len(matrixX), n_atoms, 4))
+        labels = rawArray[:, :, 0]
+        if not np.all(labels == labels[0]):
+            raise ValueError("Error: all the samples of a GeometrySet must have the same atoms in the same order.")
+
+        return cls(rawArray[:, :, 1:].astype(float), list(labels[0]))
+
+    def toList(self):
+        """
+        This function converts the geometries back to the list of lists format returned by loadX.
+
+        :return: list of lists with characters and floats.
+        """
+        matrixX = []
+        for sample in self.coords.tolist():
+            item = []
+            for label, xyz in zip(self.labels, sample):
+                item.append(str(label))
+                item.extend(xyz)
+            matrixX.append(item)
+        return matrixX
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, index):
+        # An integer gives a one sample set, so that the result is always a GeometrySet
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 if index != -1 else None)
+        return GeometrySet(self.coords[index], self.labels)
+
+
+class PaddedGeometrySet():
+    """
+    This class is the counterpart of GeometrySet for data sets that mix molecules of different sizes and compositions.
+    Every sample is padded with dummy atoms up to the size of the largest molecule, and the arrays are:
+
+    1. coords: numpy array of shape (n_samples, n_atoms, 3) with the xyz coordinates, zero for the dummy atoms
+    2. labels: numpy array of shape (n_samples, n_atoms) with the atom labels, '' for the dummy atoms
+    3. charges: numpy array of shape (n_samples, n_atoms) with the nuclear charges, zero for the dummy atoms
+    4. atomCounts: numpy array of shape (n_samples,) with the number of real atoms of each sample
+    5. mask: boolean numpy array of shape (n_samples, n_atoms), True for the real atoms
+
+    The real atoms of a sample always come first. The dummy atoms have no charge, so they only add rows and columns of
+    zeros to the Coulomb matrices. See sizeBuckets for grouping the samples by size.
+
+    :coords: list of array-like, one per sample, of shape (n_atoms_i, 3) or (3*n_atoms_i,)
+    :labels: list of lists of atom labels, one per sample
+    :n_atoms: number of atoms to pad the samples to, the size of the largest molecule if None (int)
+    """
+
+    def __init__(self, coords, labels, n_atoms=None):
+
+        atomCounts = np.array([len(item) for item in labels], dtype=np.intp)
+        if n_atoms is None:
+            n_atoms = int(atomCounts.max()) if atomCounts.shape[0] > 0 else 0
+        elif atomCounts.shape[0] > 0 and atomCounts.max() > n_atoms:
+            raise ValueError("Error: some samples have more than %d atoms." % n_atoms)
+        mask = np.arange(n_atoms) < atomCounts[:, np.newaxis]
+
+        # The real atoms of all the samples, in the row major order of the mask
+        flatLabels = np.array([label for item in labels for label in item], dtype=object)
+        flatCoords = np.concatenate([np.reshape(np.asarray(item, dtype=float), (-1, 3)) for item in coords] +
+                                    [np.zeros((0, 3))])
+        uniqueLabels, labelIdx = np.unique(flatLabels.astype(str), return_inverse=True)
+
+        self.coords = np.zeros((atomCounts.shape[0], n_atoms, 3))
+        self.coords[mask] = flatCoords
+        self.labels = np.full((atomCounts.shape[0], n_atoms), '', dtype=object)
+        self.labels[mask] = flatLabels
+        self.charges = np.zeros((atomCounts.shape[0], n_atoms))
+        self.charges[mask] = np.array([atomicCharges[label] for label in uniqueLabels])[labelIdx]
+        self.atomCounts = atomCounts
+        self.mask = mask
+        self.n_atoms = n_atoms
+        self.n_samples = atomCounts.shape[0]
+
+    @classmethod
+    def fromArrays(cls, coords, labels, charges, atomCounts):
+        """
+        This function builds a PaddedGeometrySet from arrays that are already padded, without copying them.
+
+        :return: PaddedGeometrySet
+        """
+        geometries = cls.__new__(cls)
+        geometries.coords = coords
+        geometries.labels = labels
+        geometries.charges = charges
+        geometries.atomCounts = atomCounts
+        geometries.n_samples, geometries.n_atoms = charges.shape
+        geometries.mask = np.arange(geometries.n_atoms) < atomCounts[:, np.newaxis]
+        return geometries
+
+    @classmethod
+    def fromList(cls, matrixX, n_atoms=None):
+        """
+        This function builds a PaddedGeometrySet from a list of lists in the format returned by loadX, where the samples
+        can have different numbers of atoms.
+
+        :matrixX: list of lists, for example [['H',-0.5,0.0,0.0,'H',0.5,0.0,0.0], ['C',-0.3,0.0,0.0]]
+        :n_atoms: number of atoms to pad the samples to, the size of the largest molecule if None (int)
+        :return: PaddedGeometrySet
+        """
+        labels = [item[0::4] for item in matrixX]
+        coords = [[value for i, value in enumerate(item) if i % 4 != 0] for item in matrixX]
+        return cls(coords, labels, n_atoms)
+
+    def toList(self):
+        """
+        This function converts the geometries back to the list of lists format returned by loadX, without the dummy
+        atoms.
+
+        :return: list of lists with characters and floats.
+        """
+        matrixX = []
+        for sample, labels, count in zip(self.coords.tolist(), self.labels, self.atomCounts):
+            item = []
+            for label, xyz in zip(labels[:count], sample[:count]):
+                item.append(str(label))
+                item.extend(xyz)
+            matrixX.append(item)
+        return matrixX
+
+    def buckets(self, bucketSizes=None):
+        """
+        This function groups the samples by size (see sizeBuckets).
+
+        :bucketSizes: upper limits of the groups, every number of atoms gets its own group if None (list of int)
+        :return: list of (indexes, size)
+        """
+        return sizeBuckets(self.atomCounts, bucketSizes)
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, index):
+        # Slices give views, arrays of indexes give copies, like numpy
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 if index != -1 else None)
+        return PaddedGeometrySet.fromArrays(self.coords[index], self.labels[index], self.charges[index],
+                                            self.atomCounts[index])
+
+
+def sizeBuckets(atomCounts, bucketSizes=None):
+    """
+    This function groups the samples of a data set by number of atoms, so that the samples of a group only have to be
+    padded to the largest molecule of the group instead of the largest molecule of the data set.
+
+    :atomCounts: number of atoms of each sample - numpy array of shape (n_samples,)
+    :bucketSizes: upper limits of the groups (list of int). For example [10, 20, 50] puts the molecules of up to 10 atoms
+        in the first group, those of 11 to 20 atoms in the second and those of 21 to 50 atoms in the third. Every number
+        of atoms gets its own group if None.
+    :return: list of (indexes, size), with the indexes of the samples of a group in increasing order (numpy array) and
+        the number of atoms of the largest molecule of the group (int)
+    """
+    atomCounts = np.asarray(atomCounts)
+    if bucketSizes is None:
+        bucketOf = atomCounts
+    else:
+        limits = np.sort(np.asarray(bucketSizes))
+        if atomCounts.shape[0] > 0 and atomCounts.max() > limits[-1]:
+            raise ValueError("Error: some samples have more atoms than the largest bucket size.")
+        bucketOf = np.searchsorted(limits, atomCounts)
+
+    order = np.argsort(bucketOf, kind="stable")
+    starts = np.unique(bucketOf[order], return_index=True)[1]
+    return [(indexes, int(atomCounts[indexes].max())) for indexes in np.split(order, starts[1:]) if indexes.shape[0]]
+
+
+# Cache of the indexes of the upper triangle of the Coulomb matrices, one entry per number of atoms
+_triangleCache = {}
+
+def triangleIndices(n_atoms):
+    """
+    This function returns the indexes of the upper triangle (diagonal included) of a n_atoms x n_atoms matrix, in the
+    order used by CoulombMatrix.trimAndFlat. They are computed once per value of n_atoms and then cached.
+
+    :n_atoms: number of atoms (int)
+    :return:
+    :rows: numpy array of the row indexes of shape (n_atoms*(n_atoms+1)/2,)
+    :cols: numpy array of the column indexes of shape (n_atoms*(n_atoms+1)/2,)
+    :packedIdx: numpy array of shape (n_atoms, n_atoms) with the position of element (i, j) in the packed triangle
+    """
+    if n_atoms not in _triangleCache:
+        rows, cols = np.triu_indices(n_atoms)
+        packedIdx = np.zeros((n_atoms, n_atoms), dtype=np.intp)
+        packedIdx[rows, cols] = np.arange(rows.shape[0])
+        packedIdx[cols, rows] = np.arange(rows.shape[0])
+        for item in (rows, cols, packedIdx):
+            item.flags.writeable = False
+        _triangleCache[n_atoms] = (rows, cols, packedIdx)
+
+    return _triangleCache[n_atoms]
+
+# Cache of the groups of atoms with the same nuclear charge, one entry per composition of the molecule
+_classCache = {}
+
+def equivalenceClasses(charges):
+    """
+    This function works out the order of the atoms by increasing nuclear charge and the groups of atoms with the same
+    nuclear charge, which can be permuted in the partially randomised Coulomb matrix. The result is cached for each
+    composition.
+
+    :charges: numpy array of the nuclear charges of shape (n_atoms,)
+    :return:
+    :idx_sort: numpy array of shape (n_atoms,) with the atom indexes sorted by increasing nuclear charge
+    :dupl_col: list of lists with the positions (in the sorted order) of the atoms of each group
+    :n_perm: number of possible permutations (int)
+    """
+    key = tuple(charges)
+    if key not in _classCache:
+        idx_sort = np.argsort(charges, kind="stable")
+        vals, idx_start, count = np.unique(np.asarray(charges)[idx_sort], return_counts=True, return_index=True)
+        dupl_col = [list(range(idx_start[i], idx_start[i] + count[i])) for i in range(count.shape[0])]
+        n_perm = int(np.prod(factorial(count, exact=True)))
+        idx_sort.flags.writeable = False
+        _classCache[key] = (idx_sort, dupl_col, n_perm)
+
+    return _classCache[key]
+
+def batchCM(coords, charges, maxMemory=2**28, out=None, packed=False, dtype=None):
+    """
+    This function builds the standard Coulomb matrices of a whole data set at once. The samples are processed in chunks
+    so that the temporary arrays never take more than roughly maxMemory bytes.
+
+    With packed=True only the upper triangle of each matrix is computed and stored (in the order of trimAndFlat), so
+    the full matrices are never materialised.
+
+    Dummy atoms with a nuclear charge of zero (see PaddedGeometrySet) give rows and columns of zeros.
+
+    :coords: numpy array of the xyz coordinates of shape (n_samples, n_atoms, 3)
+    :charges: numpy array of the nuclear charges of shape (n_atoms,) or (n_samples, n_atoms)
+    :maxMemory: memory ceiling in bytes for the temporary arrays of one chunk (int)
+    :out: optional preallocated numpy array of shape (n_samples, n_atoms, n_atoms) where the matrices are written (or
+        (n_samples, n_atoms*(n_atoms+1)/2) if packed is True)
+    :packed: whether to return only the upper triangle of the matrices (bool)
+    :dtype: floating point type of the computation and of the result, the type of out if given, float64 otherwise
+    :return: numpy array of shape (n_samples, n_atoms, n_atoms) or (n_samples, n_atoms*(n_atoms+1)/2) if packed
+    """
+    if dtype is None:
+        dtype = float if out is None else out.dtype
+    coords = np.asarray(coords, dtype=dtype)
+    charges = np.asarray(charges, dtype=dtype)
+    n_samples, n_atoms = coords.shape[0], coords.shape[1]
+    rows, cols, packedIdx = triangleIndices(n_atoms)
+
+    if out is None:
+        out = np.zeros((n_samples, rows.shape[0]) if packed else (n_samples, n_atoms, n_atoms), dtype=dtype)
+
+    # Distance vectors, squared distances and the result: about 6 arrays of n_atoms^2 numbers per sample
+    chunkSize = max(1, int(maxMemory // (6 * coords.itemsize * (rows.shape[0] if packed else n_atoms**2))))
+    diagIdx = np.arange(n_atoms)
+    # Dummy atoms all sit at the origin, so 0/0 has to be replaced by 0
+    hasDummies = not np.all(charges)
+
+    for start in range(0, n_samples, chunkSize):
+        stop = min(start + chunkSize, n_samples)
+        chunk = coords[start:stop]
+        Z = charges if charges.ndim == 1 else charges[start:stop]
+
+        if packed:
+            # Same operations as below, but only for the pairs (i, j) of the upper triangle
+            distanceVec = chunk[:, rows, :] - chunk[:, cols, :]
+            distance = np.sqrt(np.matmul(distanceVec[..., np.newaxis, :], distanceVec[..., :, np.newaxis])[..., 0, 0])
+            pairCharges = Z[..., rows] * Z[..., cols]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(pairCharges, distance, out=out[start:stop])
+            if hasDummies:
+                np.copyto(out[start:stop], 0.0, where=pairCharges == 0)
+            out[start:stop, packedIdx[diagIdx, diagIdx]] = 0.5 * Z ** 2.4
+            continue
+
+        # Stacked matmul of the distance vectors gives the same rounding as np.dot(distanceVec, distanceVec)
+        distanceVec = chunk[:, :, np.newaxis, :] - chunk[:, np.newaxis, :, :]
+        distance = np.sqrt(np.matmul(distanceVec[..., np.newaxis, :], distanceVec[..., :, np.newaxis])[..., 0, 0])
+
+        # Off-diagonal elements (the diagonal is a division by zero that gets overwritten below)
+        pairCharges = Z[..., :, np.newaxis] * Z[..., np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(pairCharges, distance, out=out[start:stop])
+        if hasDummies:
+            np.copyto(out[start:stop], 0.0, where=pairCharges == 0)
+
+        # Diagonal elements
+        out[start:stop, diagIdx, diagIdx] = 0.5 * Z ** 2.4
+
+    return out
+
+
+def descriptorShape(descriptor, charges, numRep=5):
+    """
+    This function returns how many rows per sample and how many features a descriptor has.
+
+    :descriptor: one of "CM", "ES", "SCM", "TriangCM", "RSCM" or "PRCM" (string)
+    :charges: numpy array of the nuclear charges of the atoms of shape (n_atoms,)
+    :numRep: number of matrices generated per sample for "RSCM" and "PRCM" (int)
+    :return: number of rows per sample (int) and number of features (int)
+    """
+    n_atoms = len(charges)
+    n_triang = int(n_atoms * (n_atoms+1) * 0.5)
+
+    if descriptor == "RSCM":
+        rowsPerSample = numRep
+    elif descriptor == "PRCM":
+        rowsPerSample = min(numRep, equivalenceClasses(charges)[2])
+    else:
+        rowsPerSample = 1
+
+    n_features = {"CM": n_atoms**2, "ES": n_atoms, "SCM": n_triang, "TriangCM": n_triang, "RSCM": n_triang,
+                  "PRCM": n_triang}
+    if descriptor not in n_features:
+        raise ValueError("Error: unknown descriptor %s." % descriptor)
+
+    return rowsPerSample, n_features[descriptor]
+
+# Shared memory buffers of generateParallel, attached once per worker process
+_sharedArrays = {}
+
+def _attachShared(coordsName, coordsShape, outName, outShape, labels, maxMemory, packed, descriptor, numRep,
+                  rowsPerSample, seed, dtype="<f8"):
+    """
+    This function is the initializer of the worker processes of generateParallel. It attaches the shared memory buffers
+    and keeps the settings of the job.
+    """
+    _sharedArrays.clear()
+    coordsShm = shared_memory.SharedMemory(name=coordsName)
+    outShm = shared_memory.SharedMemory(name=outName)
+    _sharedArrays.update(coordsShm=coordsShm, outShm=outShm,
+                         coords=np.ndarray(coordsShape, dtype=dtype, buffer=coordsShm.buf),
+                         out=np.ndarray(outShape, dtype=dtype, buffer=outShm.buf),
+                         labels=labels, maxMemory=maxMemory, packed=packed, descriptor=descriptor, numRep=numRep,
+                         rowsPerSample=rowsPerSample, seed=seed, dtype=dtype)
+
+def _generateShard(task):
+    """
+    This function generates the descriptor of one shard of samples in a worker process of generateParallel.
+
+    :task: tuple (shard index, first sample, sample after the last one)
+    """
+    shard, start, stop = task
+    job = _sharedArrays
+
+    # Each shard has its own random stream, so that the result does not depend on which worker runs it
+    np.random.seed(np.random.SeedSequence([job["seed"], shard]).generate_state(1)[0])
+
+    block = CoulombMatrix(GeometrySet(job["coords"][start:stop], job["labels"]), maxMemory=job["maxMemory"],
+                          packed=job["packed"], dtype=job["dtype"])
+    rowsPerSample = job["rowsPerSample"]
+    job["out"][start*rowsPerSample:stop*rowsPerSample, :] = block.generate(job["descriptor"], numRep=job["numRep"])
+
+def _prefetch(iterable, prefetch):
+    """
+    This function runs an iterable on a background thread and yields its items, with up to prefetch items computed
+    ahead. Errors raised on the thread are raised again in the caller. When the caller stops early (e.g. a break out of
+    the loop), the thread is stopped too.
+
+    :iterable: the iterable to run
+    :prefetch: maximum number of items waiting in the queue (int)
+    :return: generator of the items of iterable
+    """
+    items = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(message):
+        while not stop.is_set():
+            try:
+                items.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(("item", item)):
+                    return
+            put(("done", None))
+        except BaseException as error:
+            put(("error", error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 class CoulombMatrix():
     """This class contains the functions required to generate the following variations of  Coulomb matrices (with nuclear charges) for M configurations of N atoms:
 
@@ -182,83 +736,159 @@ class CoulombMatrix():
 
     When it is initialised, the raw data of each configuration with atom labels and their xyz coordinates is passed.
 
-    :matrixX: list of lists, where each of the inner lists represents a sample configuration. An example is shown below: [ [ 'C', 0.1, 0.3, 0.5, 'H', 0.0, 0.5 1.0, 'H', 0.0, -0.5, -1.0, ....], [...], ... ].
+    The samples can also have different numbers of atoms (a PaddedGeometrySet, or lists of different lengths). They are
+    then padded with dummy atoms to the size of the largest molecule, and all the descriptors have the size of the
+    largest molecule: the rows and columns of the dummy atoms are zero and come last in the sorted matrices, and the
+    eigen spectra end with zeros. The samples are processed in groups of similar size (see sizeBuckets), so that the
+    distances, sorts and eigenvalues of small molecules are computed at their own size.
+
+    :matrixX: list of lists, where each of the inner lists represents a sample configuration. An example is shown below: [ [ 'C', 0.1, 0.3, 0.5, 'H', 0.0, 0.5 1.0, 'H', 0.0, -0.5, -1.0, ....], [...], ... ]. A GeometrySet or a PaddedGeometrySet can be passed instead, in which case its arrays are used directly.
+    :maxMemory: memory ceiling in bytes used when building the Coulomb matrices in chunks (see batchCM).
+    :packed: if True only the upper triangle of each Coulomb matrix is stored, which halves the memory used. The full
+        matrices are then only rebuilt one chunk at a time when a descriptor needs them.
+    :bucketSizes: upper limits of the size groups for samples of different sizes, see sizeBuckets (list of int)
+    :dtype: floating point type of the coordinates, the Coulomb matrices and all the descriptors. np.float32 halves the
+        memory and bandwidth used, for models that are trained in single precision anyway. The sorted descriptors can
+        then differ from the float64 ones where two rows have norms within rounding of each other, see compareDtypes.
+
+    New samples can be added later with append, which only computes the Coulomb matrices (and the stored sorted,
+    triangular and eigen spectrum descriptors) of the new samples.
 
     """
 
-    def __init__(self, matrixX):
+    def __init__(self, matrixX, maxMemory=2**28, packed=False, bucketSizes=None, dtype=np.float64):
 
         self.rawX = matrixX
-        self.Z = {
-                    'C': 6.0,
-                    'H': 1.0,
-                    'N': 7.0
-                 }
-
-        self.n_atoms = int(len(self.rawX[0])/4)
-        self.n_samples = len(self.rawX)
+        self.Z = atomicCharges
+        self.maxMemory = maxMemory
+        self.bucketSizes = bucketSizes
+        self.dtype = np.dtype(dtype)
+        self.mask = None
+        self.__storage = {}
+
+        if not isinstance(matrixX, (GeometrySet, PaddedGeometrySet)) and len({len(item) for item in matrixX}) > 1:
+            matrixX = PaddedGeometrySet.fromList(matrixX)
+
+        if isinstance(matrixX, GeometrySet):
+            self.n_atoms = matrixX.n_atoms
+            self.n_samples = matrixX.n_samples
+            self.coords = matrixX.coords.astype(self.dtype, copy=False)
+            self.labels = matrixX.labels
+            self.charges = matrixX.charges
+        elif isinstance(matrixX, PaddedGeometrySet):
+            self.n_atoms = matrixX.n_atoms
+            self.n_samples = matrixX.n_samples
+            self.coords = matrixX.coords.astype(self.dtype, copy=False)
+            self.labels = None
+            self.charges = matrixX.charges
+            if not np.all(matrixX.mask):
+                self.mask = matrixX.mask
+                self.atomCounts = matrixX.atomCounts
+                self.buckets = sizeBuckets(self.atomCounts, bucketSizes)
+        else:
+            self.n_atoms = int(len(self.rawX[0])/4)
+            self.n_samples = len(self.rawX)
+
+            # Dense copy of the raw data: the xyz coordinates of all the samples and the nuclear charge of each atom
+            rawArray = np.asarray(self.rawX, dtype=object).reshape((self.n_samples, self.n_atoms, 4))
+            self.coords = rawArray[:, :, 1:].astype(self.dtype)
+            labels = rawArray[:, :, 0]
+            if np.all(labels == labels[0]):
+                self.labels = labels[0].astype(str)
+                self.charges = np.array([self.Z[label] for label in labels[0]])
+            else:
+                self.labels = None
+                self.charges = np.array([[self.Z[label] for label in item] for item in labels])
 
+        self.packed = packed
+        self.triangle = triangleIndices(self.n_atoms)
+        n_triang = self.triangle[0].shape[0]
 
-        self.coulMatrix = np.zeros((self.n_samples, self.n_atoms**2))
+        self.coulMatrix = np.zeros((self.n_samples, n_triang if self.packed else self.n_atoms**2), dtype=self.dtype)
         self.__generateCM()
 
     def getCM(self):
         """
-        This function returns the standard Coulomb matrix. Each line is the flattened matrix for each sample.
+        This function returns the standard Coulomb matrix. Each line is the flattened matrix for each sample. In packed
+        mode the full matrices are rebuilt from the stored triangles, use getPackedCM to avoid that.
 
         :return: numpy array of shape (n_samples, n_atoms**2)
         """
+        if self.packed:
+            return np.reshape(self.getFullCM(0, self.n_samples), (self.n_samples, self.n_atoms**2))
         return self.coulMatrix
 
-    def __generateCM(self):
+    def getPackedCM(self):
         """
-        This function generates the standard Coulomb Matrix descriptor as a numpy array of size (n_samples, n_atoms^2).
-        Each line is the matrix for one sample.
-        """
-
-        # This is a coulomb matrix for one particular sample in the dataset
-        indivCM = np.zeros((self.n_atoms, self.n_atoms))
-        sampleCount = 0
+        This function returns the upper triangle of the standard Coulomb matrix of each sample. Without packed mode this
+        is the same as generateTriangCM.
 
-        for item in self.rawX:
-
-            labels = ""  # This is a string containing all the atom labels
-            coord = []  # This is a list of tuples with the coordinates of all the atoms in a configuration
-
-            # This gathers the atom labels and the coordinates for one sample
-            for i in range(0, len(item), 4):
-                labels += item[i]
-                coord.append(np.array([float(item[i + 1]), float(item[i + 2]), float(item[i + 3])]))
-
-            # Diagonal elements
-            for i in range(self.n_atoms):
-                indivCM[i, i] = 0.5 * self.Z[labels[i]] ** 2.4
+        :return: numpy array of shape (n_samples, n_atoms*(n_atoms+1)/2)
+        """
+        if self.packed:
+            return self.coulMatrix
+        return self.generateTriangCM()
 
-            # Off-diagonal elements
-            for i in range(self.n_atoms - 1):
-                for j in range(i + 1, self.n_atoms):
-                    distanceVec = coord[i] - coord[j]
-                    distance = np.sqrt(np.dot(distanceVec, distanceVec))
-                    indivCM[i, j] = self.Z[labels[i]] * self.Z[labels[j]] / distance
-                    indivCM[j, i] = indivCM[i, j]
+    def getFullCM(self, start, stop):
+        """
+        This function returns the standard Coulomb matrices of the samples start to stop as a 3D array. Without packed
+        mode this is a view on the stored matrices.
 
-            # The coulomb matrix for each sample is flattened and added to the total coulomb matrix
-            self.coulMatrix[sampleCount, :] = indivCM.flatten()
-            sampleCount += 1
+        :start: index of the first sample (int)
+        :stop: index after the last sample (int)
+        :return: numpy array of shape (stop-start, n_atoms, n_atoms)
+        """
+        if self.packed:
+            return self.coulMatrix[start:stop, self.triangle[2]]
+        return np.reshape(self.coulMatrix[start:stop, :], (-1, self.n_atoms, self.n_atoms))
 
-    def generateES(self):
+    def __generateCM(self):
+        """
+        This function generates the standard Coulomb Matrix descriptor as a numpy array of size (n_samples, n_atoms^2).
+        Each line is the matrix for one sample.
+        """
+        if self.mask is not None:
+            # Each group of samples only gets the matrices of its own size, the rest of the padding stays zero
+            for samples, size in self.__blocks(lambda n: 8 * 7 * n**2):
+                tempCM = batchCM(self.coords[samples, :size], self.charges[samples, :size], maxMemory=self.maxMemory,
+                                 packed=self.packed, dtype=self.dtype)
+                if self.packed:
+                    self.__store(self.coulMatrix, samples, self.__triangPositions(size), tempCM)
+                else:
+                    out = np.reshape(self.coulMatrix, (self.n_samples, self.n_atoms, self.n_atoms))
+                    out[samples, :size, :size] = tempCM
+        elif self.packed:
+            batchCM(self.coords, self.charges, maxMemory=self.maxMemory, out=self.coulMatrix, packed=True)
+        else:
+            out = np.reshape(self.coulMatrix, (self.n_samples, self.n_atoms, self.n_atoms))
+            batchCM(self.coords, self.charges, maxMemory=self.maxMemory, out=out)
+
+    def generateES(self, nThreads=None):
         """
-        This function calculates the eigen spectrum from the standard Coulomb matrix.
+        This function calculates the eigen spectrum from the standard Coulomb matrix. Since the Coulomb matrices are
+        symmetric, the eigenvalues are real and they are computed with the symmetric solver LA.eigvalsh for a whole
+        chunk of matrices at a time. The eigenvalues of each sample are sorted in descending order.
+
+        Most of the time is spent in LAPACK, which releases the GIL, so the chunks can be processed by a pool of
+        nThreads threads. Each thread works on its own chunk, so the memory used is about nThreads times maxMemory.
 
+        :nThreads: number of threads to use, None or 1 to run on the calling thread only (int)
         :return: numpy array of shape (n_samples, n_atoms)
         """
 
-        self.coulES = np.zeros((self.n_samples, self.n_atoms))
+        self.coulES = np.zeros((self.n_samples, self.n_atoms), dtype=self.dtype)
 
-        for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i, :], (self.n_atoms, self.n_atoms))
-            tempES, tempDiag = LA.eig(tempCM)
-            self.coulES[i,:] = tempES
+        def eigenChunk(chunk):
+            samples, size = chunk
+            self.__store(self.coulES, samples, slice(0, size), self.__esBlock(self.__blockCM(samples, size), samples))
+
+        chunks = list(self.__blocks(lambda n: 8 * 3 * n**2, minChunks=nThreads or 1))
+        if nThreads is None or nThreads <= 1:
+            for chunk in chunks:
+                eigenChunk(chunk)
+        else:
+            with ThreadPoolExecutor(max_workers=nThreads) as pool:
+                list(pool.map(eigenChunk, chunks))
 
         return self.coulES
 
@@ -270,23 +900,16 @@ class CoulombMatrix():
         :return: numpy array of size (N_samples, n_atoms*(n_atoms+1)/2)
         """
 
-        coulS = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
-
-        for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i, :], (self.n_atoms, self.n_atoms))
+        n_triang = int(self.n_atoms * (self.n_atoms+1) * 0.5)
+        coulS = np.zeros((self.n_samples, n_triang), dtype=self.dtype)
 
-            # Sorting the Coulomb matrix rows and columns in descending order of the norm of each row.
-            rowNorms = np.zeros(self.n_atoms)
-            for j in range(self.n_atoms):
-                rowNorms[j] = LA.norm(tempCM[j, :])
-
-            permutations = np.argsort(rowNorms)
-            permutations = permutations[::-1]
-
-            tempCM = tempCM[permutations, :]
-            tempCM = tempCM[:, permutations]
-            coulS[i, :] = self.trimAndFlat(tempCM)
+        for samples, size in self.__blocks(lambda n: 8 * (2 * n**2 + 1.5 * n * (n+1))):
+            tempCM = self.__blockCM(samples, size)
+            mask = None if self.mask is None else self.mask[samples, :size]
+            self.__store(coulS, samples, self.__triangPositions(size),
+                         self.__scmBlock(tempCM, self.__rowNorms(tempCM), mask))
 
+        self.coulS = coulS
         return coulS
 
     def generateRSCM(self, y_data, numRep=5):
@@ -305,37 +928,339 @@ class CoulombMatrix():
         elif(numRep < 1):
             raise ValueError("Error: you cannot generate less than 1 RSCM per sample. Enter an integer value > 1.")
 
-        counter = 0
-        coulRS = np.zeros((self.n_samples*numRep, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
-        y_bigdata = np.zeros((self.n_samples*numRep,))
+        n_triang = int(self.n_atoms * (self.n_atoms+1) * 0.5)
+        coulRS = np.zeros((self.n_samples*numRep, n_triang), dtype=self.dtype)
 
-        for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i, :], (self.n_atoms, self.n_atoms))
+        bytesPerSample = lambda n: 8 * (2 * n**2 + numRep * (4 * n + 1.5 * n * (n+1)))
+        for samples, size in self.__blocks(bytesPerSample):
+            tempCM = self.__blockCM(samples, size)
+            mask = None if self.mask is None else self.mask[samples, :size]
+            result = self.__rscmBlock(tempCM, self.__rowNorms(tempCM), mask, numRep)
+            self.__store(coulRS, self.__replicaRows(samples, numRep), self.__triangPositions(size),
+                         np.reshape(result, (-1, result.shape[-1])))
 
-            # Calculating the norm vector for the coulomb matrix
-            rowNorms = np.zeros(self.n_atoms)
+        # Copying multiple values of the energies
+        y_bigdata = np.repeat(np.asarray(y_data, dtype=float), numRep)
 
-            for j in range(self.n_atoms):
-                rowNorms[j] = LA.norm(tempCM[j, :])
+        return coulRS, y_bigdata
 
-            for k in range(numRep):
-                # Generating random vectors and adding to the norm vector
-                randVec = np.random.normal(loc=0.0, scale=np.std(rowNorms), size=self.n_atoms)
-                rowNormRan = rowNorms + randVec
-                # Sorting the new random norm vector
-                permutations = np.argsort(rowNormRan)
-                permutations = permutations[::-1]
-                # Sorting accordingly the Coulomb matrix
-                tempRandCM = tempCM[permutations, :]
-                tempRandCM = tempRandCM[:,permutations]
-                # Adding flattened and trimmed randomly sorted Coulomb matrix to the final descriptor matrix
-                coulRS[counter, :] = self.trimAndFlat(tempRandCM)
-                counter = counter + 1
+    def __chunks(self, bytesPerSample, minChunks=1, maxMemory=None):
+        """
+        This function splits the samples in chunks so that the temporary arrays of one chunk take roughly maxMemory bytes.
 
-            # Copying multiple values of the energies
-            y_bigdata[numRep*i:numRep*i+numRep] = y_data[i]
+        :bytesPerSample: memory needed to process one sample (int)
+        :minChunks: minimum number of chunks to split the samples in, e.g. to keep several threads busy (int)
+        :maxMemory: memory ceiling in bytes of one chunk, self.maxMemory if None (int)
+        :return: generator of (start, stop) sample indexes
+        """
+        maxMemory = self.maxMemory if maxMemory is None else maxMemory
+        chunkSize = max(1, min(int(maxMemory // bytesPerSample), -(-self.n_samples // minChunks)))
+        for start in range(0, self.n_samples, chunkSize):
+            yield start, min(start + chunkSize, self.n_samples)
 
-        return coulRS, y_bigdata
+    def append(self, matrixX):
+        """
+        This function adds new samples, for example the new geometries of an active learning cycle. Only the Coulomb
+        matrices of the new samples are computed, and the descriptors already stored by generateTriangCM, generateSCM
+        and generateES (trimCM, coulS and coulES) are extended with the rows of the new samples. The other descriptors
+        cover all the samples the next time they are generated.
+
+        The arrays are kept in buffers that double in size when they are full, so appending many small batches costs
+        time proportional to the number of new samples. Arrays returned before the call stay unchanged.
+
+        :matrixX: the new geometries, in any format accepted by CoulombMatrix. They must not have more atoms than
+            n_atoms. Smaller molecules are padded with dummy atoms.
+        :return: the indexes of the new samples (slice)
+        """
+        if not isinstance(matrixX, (GeometrySet, PaddedGeometrySet)):
+            try:
+                matrixX = GeometrySet.fromList(matrixX)
+            except ValueError:
+                # Samples of different sizes or compositions
+                matrixX = PaddedGeometrySet.fromList(matrixX, n_atoms=self.n_atoms)
+        if matrixX.n_atoms > self.n_atoms:
+            raise ValueError("Error: the new samples have more atoms (%d) than the others (%d)."
+                             % (matrixX.n_atoms, self.n_atoms))
+        if matrixX.n_atoms < self.n_atoms:
+            matrixX = PaddedGeometrySet.fromList(matrixX.toList(), n_atoms=self.n_atoms)
+
+        new = CoulombMatrix(matrixX, maxMemory=self.maxMemory, packed=self.packed, bucketSizes=self.bucketSizes,
+                            dtype=self.dtype)
+        start, stop = self.n_samples, self.n_samples + new.n_samples
+
+        # The charges stay shared by all the samples as long as the atoms are the same
+        sameAtoms = (self.labels is not None and new.labels is not None and
+                     np.array_equal(self.labels, new.labels))
+        if not sameAtoms and self.charges.ndim == 1:
+            self.charges = np.broadcast_to(self.charges, (self.n_samples, self.n_atoms))
+        if not sameAtoms:
+            self.charges = self.__extend("charges", np.broadcast_to(new.charges, (new.n_samples, self.n_atoms)))
+            self.labels = None
+
+        if self.mask is not None or new.mask is not None:
+            if self.mask is None:
+                self.mask = np.ones((self.n_samples, self.n_atoms), dtype=bool)
+                self.atomCounts = np.full(self.n_samples, self.n_atoms, dtype=np.intp)
+            newMask = new.mask if new.mask is not None else np.ones((new.n_samples, self.n_atoms), dtype=bool)
+            self.mask = self.__extend("mask", newMask)
+            self.atomCounts = self.__extend("atomCounts", np.count_nonzero(newMask, axis=-1))
+            self.buckets = sizeBuckets(self.atomCounts, self.bucketSizes)
+
+        self.coords = self.__extend("coords", new.coords)
+        self.coulMatrix = self.__extend("coulMatrix", new.coulMatrix)
+        for name, method in (("trimCM", new.generateTriangCM), ("coulS", new.generateSCM), ("coulES", new.generateES)):
+            if hasattr(self, name):
+                setattr(self, name, self.__extend(name, method()))
+
+        self.n_samples = stop
+        return slice(start, stop)
+
+    def __extend(self, name, rows):
+        """
+        This function appends rows to one of the per-sample arrays, in a buffer with room to grow. The buffer is
+        (re)created from the current array when the array is not a view on it, e.g. after a generate method replaced it.
+
+        :name: name of the attribute (string)
+        :rows: numpy array of the new rows
+        :return: view on the first n_samples + len(rows) rows of the buffer
+        """
+        current = getattr(self, name)
+        buffer = self.__storage.get(name)
+        if buffer is None or current.base is not buffer or current.shape[0] != self.n_samples:
+            buffer = current
+
+        needed = self.n_samples + rows.shape[0]
+        if buffer is current or needed > buffer.shape[0]:
+            capacity = max(needed, 2 * buffer.shape[0], 16)
+            grown = np.empty((capacity,) + current.shape[1:], dtype=current.dtype)
+            grown[:self.n_samples] = current
+            buffer = grown
+            self.__storage[name] = buffer
+
+        buffer[self.n_samples:needed] = rows
+        return buffer[:needed]
+
+    def __blocks(self, bytesPerSample, minChunks=1, maxMemory=None):
+        """
+        This function splits the samples in blocks for the methods that work on one block of Coulomb matrices at a time.
+        Without padding the blocks are the chunks of __chunks. With samples of different sizes, each block only holds
+        samples of one size group (see sizeBuckets), and is processed at the size of the group.
+
+        :bytesPerSample: function giving the memory needed to process one sample for a number of atoms
+        :minChunks: minimum number of blocks to split the samples in, e.g. to keep several threads busy (int)
+        :maxMemory: memory ceiling in bytes of one block, self.maxMemory if None (int)
+        :return: generator of (samples, size), where samples is a slice or a numpy array of sample indexes and size the
+            number of atoms to use for the block (int)
+        """
+        if self.mask is None:
+            for start, stop in self.__chunks(bytesPerSample(self.n_atoms), minChunks, maxMemory):
+                yield slice(start, stop), self.n_atoms
+            return
+
+        maxMemory = self.maxMemory if maxMemory is None else maxMemory
+        for indexes, size in self.buckets:
+            chunkSize = max(1, min(int(maxMemory // bytesPerSample(size)), -(-indexes.shape[0] // minChunks)))
+            for start in range(0, indexes.shape[0], chunkSize):
+                yield indexes[start:start + chunkSize], size
+
+    def __blockCM(self, samples, size):
+        """
+        This function returns the Coulomb matrices of a block of samples (see __blocks), cut to size atoms.
+
+        :return: numpy array of shape (n_block_samples, size, size)
+        """
+        if isinstance(samples, slice) and size == self.n_atoms:
+            return self.getFullCM(samples.start, samples.stop)
+        if self.packed:
+            return self.coulMatrix[samples][:, self.triangle[2][:size, :size]]
+        return np.reshape(self.coulMatrix, (self.n_samples, self.n_atoms, self.n_atoms))[samples, :size, :size]
+
+    def __triangPositions(self, size):
+        """
+        This function returns where the triangle of a matrix of size atoms goes in the triangle of a matrix of n_atoms
+        atoms, the dummy atoms coming last.
+
+        :return: slice or numpy array of shape (size*(size+1)/2,)
+        """
+        if size == self.n_atoms:
+            return slice(None)
+        rows, cols = triangleIndices(size)[:2]
+        return self.triangle[2][rows, cols]
+
+    def __store(self, out, rows, cols, values):
+        """
+        This function writes a block of results in an output array, for rows and columns given as slices or arrays.
+        """
+        if isinstance(rows, np.ndarray) and isinstance(cols, np.ndarray):
+            out[np.ix_(rows, cols)] = values
+        else:
+            out[rows, cols] = values
+
+    def __movePadding(self, eigenvalues, padding):
+        """
+        This function moves the eigenvalues of the dummy atoms, which are zero, to the end of the eigen spectra. For
+        each sample, the padding eigenvalues closest to zero are taken as those of the dummy atoms.
+
+        :eigenvalues: numpy array of shape (n_block_samples, size) sorted in descending order
+        :padding: number of dummy atoms of each sample - numpy array of shape (n_block_samples,)
+        :return: numpy array of shape (n_block_samples, size)
+        """
+        rank = np.empty(eigenvalues.shape, dtype=np.intp)
+        np.put_along_axis(rank, np.argsort(np.abs(eigenvalues), axis=-1, kind="stable"),
+                          np.arange(eigenvalues.shape[1]), axis=-1)
+        isDummy = rank < padding[:, np.newaxis]
+        order = np.argsort(np.where(isDummy, np.inf, -eigenvalues), axis=-1, kind="stable")
+        return np.take_along_axis(np.where(isDummy, 0.0, eigenvalues), order, axis=-1)
+
+    def __replicaRows(self, samples, numRep):
+        """
+        This function returns the output rows of the numRep replicas of a block of samples, for RSCM and PRCM.
+
+        :samples: slice or numpy array of sample indexes
+        :return: slice or numpy array of row indexes
+        """
+        if isinstance(samples, slice):
+            return slice(samples.start*numRep, samples.stop*numRep)
+        return (samples[:, np.newaxis] * numRep + np.arange(numRep)).ravel()
+
+    def __esBlock(self, tempCM, samples):
+        """
+        This function returns the eigen spectra of a block of Coulomb matrices (see __blocks), in descending order with
+        the eigenvalues of the dummy atoms last.
+
+        :return: numpy array of shape (n_block_samples, size)
+        """
+        eigenvalues = LA.eigvalsh(tempCM)[:, ::-1]
+        if self.mask is not None:
+            eigenvalues = self.__movePadding(eigenvalues, tempCM.shape[-1] - self.atomCounts[samples])
+        return eigenvalues
+
+    def __scmBlock(self, tempCM, rowNorms, mask):
+        """
+        This function sorts the rows and columns of a block of Coulomb matrices in descending order of the norm of each
+        row, the dummy atoms last, and returns their triangular parts.
+
+        :tempCM: numpy array of shape (n_block_samples, size, size)
+        :rowNorms: norms of the rows of tempCM (see __rowNorms), left unchanged
+        :mask: which atoms are real, numpy array of shape (n_block_samples, size), None without padding
+        :return: numpy array of shape (n_block_samples, size*(size+1)/2)
+        """
+        if mask is not None:
+            rowNorms = np.where(mask, rowNorms, -np.inf)
+        permutations = np.argsort(rowNorms, axis=-1)[:, ::-1]
+        return self.__sortAndTrim(tempCM, permutations)
+
+    def __rscmBlock(self, tempCM, rowNorms, mask, numRep):
+        """
+        This function generates numRep randomly sorted matrices for each matrix of a block. All the random vectors of
+        the block are drawn in one call, in the same order as one call per sample and replica would, and added to the
+        norm vectors. The dummy atoms do not count in the spread and always stay last.
+
+        :tempCM: numpy array of shape (n_block_samples, size, size)
+        :rowNorms: norms of the rows of tempCM (see __rowNorms), left unchanged
+        :mask: which atoms are real, numpy array of shape (n_block_samples, size), None without padding
+        :return: numpy array of shape (n_block_samples, numRep, size*(size+1)/2)
+        """
+        size = tempCM.shape[-1]
+        if mask is None:
+            scale = np.std(rowNorms, axis=-1)[:, np.newaxis, np.newaxis]
+        else:
+            scale = np.std(rowNorms, axis=-1, where=mask)[:, np.newaxis, np.newaxis]
+        randVec = np.random.normal(loc=0.0, scale=scale, size=(tempCM.shape[0], numRep, size))
+        rowNormRan = rowNorms[:, np.newaxis, :] + randVec
+        if mask is not None:
+            rowNormRan[np.broadcast_to(~mask[:, np.newaxis, :], rowNormRan.shape)] = -np.inf
+
+        # Sorting the new random norm vectors and sorting accordingly the Coulomb matrices
+        permutations = np.argsort(rowNormRan, axis=-1)[:, :, ::-1]
+        return self.__sortAndTrim(tempCM, permutations)
+
+    def __prcmSetup(self, numRep, mode="random"):
+        """
+        This function works out what the PRCM of the samples needs: the order of the atoms by increasing nuclear charge
+        and the groups of atoms (in that order) that can be permuted, and for the "unique" and "exhaustive" modes the
+        list of all the permutations.
+
+        :return: dictionary with idx_sort, dupl_col, n_perm, n_out (number of matrices per sample), mode and allPerm
+        """
+        if mode not in ("random", "unique", "exhaustive"):
+            raise ValueError("Error: unknown mode %s for the PRCM." % mode)
+
+        if self.charges.ndim == 1:
+            idx_sort, dupl_col, n_perm = equivalenceClasses(self.charges)
+        else:
+            idx_sort = np.argsort(self.charges, axis=-1, kind="stable")
+            sortedCharges = np.take_along_axis(self.charges, idx_sort, axis=-1)
+            if not np.all(sortedCharges == sortedCharges[0]):
+                raise ValueError("Error: the PRCM needs all the samples to have the same composition.")
+            dupl_col, n_perm = equivalenceClasses(sortedCharges[0])[1:]
+
+        allPerm = None
+        if mode != "random":
+            if n_perm > 10**6:
+                raise ValueError("Error: there are too many permutations (%d) to enumerate them." % n_perm)
+            allPerm = np.array([[item for group in perm for item in group]
+                                for perm in itertools.product(*[itertools.permutations(group) for group in dupl_col])])
+
+        n_out = n_perm if mode == "exhaustive" else min(numRep, n_perm)
+        return {"idx_sort": idx_sort, "dupl_col": dupl_col, "n_perm": n_perm, "n_out": n_out, "mode": mode,
+                "allPerm": allPerm}
+
+    def __prcmBlock(self, tempCM, samples, prcm, randomState=None):
+        """
+        This function generates the partially randomised matrices of a block of samples.
+
+        :tempCM: full Coulomb matrices of the block, numpy array of shape (n_block_samples, n_atoms, n_atoms)
+        :samples: slice or numpy array of the sample indexes of the block
+        :prcm: settings from __prcmSetup
+        :randomState: np.random.RandomState to draw the permutations from, the global np.random if None
+        :return: numpy array of shape (n_block_samples, n_out, n_atoms*(n_atoms+1)/2)
+        """
+        n_block, n_out, n_perm, mode = tempCM.shape[0], prcm["n_out"], prcm["n_perm"], prcm["mode"]
+        random = np.random if randomState is None else randomState
+
+        # Permutations of the positions in the sorted matrix, of shape (n_block, n_out, n_atoms)
+        if mode == "random":
+            permut_idx = self.permutations(prcm["dupl_col"], n_block * n_out, self.n_atoms,
+                                           randomState=randomState).reshape((n_block, n_out, -1))
+        elif mode == "unique":
+            choice = np.argsort(random.random_sample((n_block, n_perm)), axis=-1)[:, :n_out]
+            permut_idx = prcm["allPerm"][choice]
+        else:
+            permut_idx = np.broadcast_to(prcm["allPerm"], (n_block, n_perm, self.n_atoms))
+
+        # Going back to the original atom indexes, so that sorting and permuting are done in the same gather
+        idx_sort = prcm["idx_sort"]
+        if idx_sort.ndim == 1:
+            permut_idx = idx_sort[permut_idx]
+        else:
+            permut_idx = np.take_along_axis(idx_sort[samples, np.newaxis, :], permut_idx, axis=-1)
+
+        return self.__sortAndTrim(tempCM, permut_idx)
+
+    def __rowNorms(self, X):
+        """
+        This function calculates the norm of every row of a batch of Coulomb matrices. A stacked matmul is used so that
+        the result is identical to calling LA.norm on each row.
+
+        :X: numpy array of shape (n_matrices, n_atoms, n_atoms)
+        :return: numpy array of shape (n_matrices, n_atoms)
+        """
+        return np.sqrt(np.matmul(X[..., np.newaxis, :], X[..., :, np.newaxis])[..., 0, 0])
+
+    def __sortAndTrim(self, X, permutations):
+        """
+        This function reorders the rows and columns of a batch of Coulomb matrices and returns their triangular part. It
+        is equivalent to X[permutations, :][:, permutations] followed by trimAndFlat for each matrix, but it only gathers
+        the elements of the triangular part, in a single indexing operation for the whole batch.
+
+        :X: numpy array of shape (n_matrices, n_atoms, n_atoms)
+        :permutations: numpy array of shape (n_matrices, n_atoms) or (n_matrices, n_rep, n_atoms)
+        :return: numpy array of shape (n_matrices, n_atoms*(n_atoms+1)/2) or (n_matrices, n_rep, n_atoms*(n_atoms+1)/2)
+        """
+        rows, cols, packedIdx = triangleIndices(X.shape[-1])
+        matrixIdx = np.arange(X.shape[0]).reshape((-1,) + (1,) * (permutations.ndim - 1))
+        return X[matrixIdx, permutations[..., rows], permutations[..., cols]]
 
     def generateTriangCM(self):
         """
@@ -343,96 +1268,62 @@ class CoulombMatrix():
 
         :return: numpy array of shape (n_samples, n_atoms * (n_atoms+1)/2 )
         """
-        self.trimCM = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
-
-        for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i,:], (self.n_atoms, self.n_atoms))
-            self.trimCM[i,:] = self.trimAndFlat(tempCM)
+        if self.packed:
+            self.trimCM = self.coulMatrix.copy()
+        else:
+            self.trimCM = self.trimAndFlat(np.reshape(self.coulMatrix, (self.n_samples, self.n_atoms, self.n_atoms)))
 
         return self.trimCM
 
     def trimAndFlat(self, X):
         """
-        This function takes one Coulomb matrix and returns the triangular part of it as a vector.
+        This function takes one Coulomb matrix, or a batch of them, and returns the triangular part as a vector. The
+        elements are gathered in one go with the cached indexes of triangleIndices.
 
-        :X: Coulomb matrix for *one* sample. numpy array of shape (n_atoms, n_atoms)
-        :return: numpy array of shape (n_atoms*(n_atoms+1)/2, )
+        :X: Coulomb matrix for one sample - numpy array of shape (n_atoms, n_atoms), or a batch of matrices of shape
+            (..., n_atoms, n_atoms)
+        :return: numpy array of shape (n_atoms*(n_atoms+1)/2, ), or (..., n_atoms*(n_atoms+1)/2) for a batch
         """
-        size = int(self.n_atoms * (self.n_atoms+1) * 0.5)
-        temp = np.zeros((size,))
-        counter = 0
-
-        for i in range(self.n_atoms):
-            for j in range(i, self.n_atoms):
-                temp[counter] = X[i][j]
-                counter = counter + 1
-
-        return temp
+        X = np.asarray(X)
+        rows, cols, packedIdx = triangleIndices(X.shape[-1])
+        return X[..., rows, cols]
 
-    def generatePRCM(self, y_data, numRep=2):
+    def generatePRCM(self, y_data, numRep=2, mode="random"):
         """
         This function generates the partially randomised Coulomb matrix. This consists in a matrix where the columns and
         rows corresponding to each atom are ordered with increasing nuclear charge and when there are atoms with the
         same nuclear charge the columns and rows are randomised.
 
+        The groups of atoms with the same nuclear charge only depend on the composition of the molecule, so they are
+        worked out once (see equivalenceClasses). The permutations are then drawn for all the samples of a chunk at once
+        and applied to the sorted matrices in a single gather. There are three ways of choosing the permutations:
+
+        1. "random": min(numRep, n_perm) random permutations per sample, which can contain duplicates
+        2. "unique": min(numRep, n_perm) different permutations per sample, drawn from the list of all of them
+        3. "exhaustive": all the n_perm permutations for every sample, numRep is ignored
+
         :y_data: the energies for each sample - numpy array of shape (n_samples,)
         :numRep: The largest number of permutations to be carried out
+        :mode: "random", "unique" or "exhaustive" (string)
         :return: the new Coulomb matrix - numpy array of shape (n_samples*n, n_features) and the y array of shape (n_samples*min(n_perm, numRep),)
         """
-        PRCM = []
-
-        for j in range(self.n_samples):
-            flatMat = self.coulMatrix[j, :]
-            currentMat = np.reshape(flatMat, (self.n_atoms, self.n_atoms))
-
-            # Check if there are two elements that are the same (check elements along diagonal)
-            diag = currentMat.diagonal()
-            idx_sort = np.argsort(diag)
-            sorted_diag = diag[idx_sort]
-            vals, idx_start, count = np.unique(sorted_diag, return_counts=True, return_index=True)
+        prcm = self.__prcmSetup(numRep, mode)
+        n_out = prcm["n_out"]
 
-            # Work out the number of possible permutations n_perm
-            permarr = factorial(count)
-            n_perm = int(np.prod(permarr))
+        n_triang = int(self.n_atoms * (self.n_atoms+1) * 0.5)
+        PRCM = np.zeros((self.n_samples*n_out, n_triang), dtype=self.dtype)
 
-            # Decide which one is smaller, numRep or n_perm
-            if numRep >= n_perm:
-                isNumRepBigger = True
-            else:
-                isNumRepBigger = False
-
-            # Finding out which rows/columns need permuting. Each element of dupl_col is a list of the indexes of the
-            # columns that can be permuted.
-            dupl_col = []
-            for j in range(count.shape[0]):
-                dupl_ind = range(idx_start[j],idx_start[j]+count[j])
-                dupl_col.append(dupl_ind)
-
-            # Permute the appropriate indexes randmoly
-            if isNumRepBigger:
-                permut_idx = self.permutations(dupl_col, n_perm, self.n_atoms)
-            else:
-                permut_idx = self.permutations(dupl_col, numRep, self.n_atoms)
-
-            # Order the rows/coloumns in terms of smallest to largest diagonal element
-            currentMat = currentMat[idx_sort, :]
-            currentMat = currentMat[:, idx_sort]
-
-            # Apply the permutations that have been obtained to the rows and columns
-            for i in range(min(numRep,n_perm)):
-                currentMat = currentMat[permut_idx[i], :]
-                currentMat = currentMat[:, permut_idx[i]]
-                PRCM.append(self.trimAndFlat(currentMat))
-
-        # Turn PRCM into a numpy array of size (n_samples*min(n_perm, numRep), n_features)
-        PRCM = np.asarray(PRCM)
+        bytesPerSample = 8 * (2 * self.n_atoms**2 + n_out * (4 * self.n_atoms + 3 * n_triang) + 2 * prcm["n_perm"])
+        for start, stop in self.__chunks(bytesPerSample):
+            result = self.__prcmBlock(self.getFullCM(start, stop), slice(start, stop), prcm)
+            PRCM[start*n_out:stop*n_out, :] = np.reshape(result, (-1, n_triang))
 
         # Modify the shape of y
-        y_big = np.asarray(np.repeat(y_data,min(n_perm, numRep)))
+        y_big = np.repeat(np.asarray(y_data, dtype=float), n_out)
 
         return PRCM, y_big
 
-    def permutations(self, col_idx, num_perm, n_atoms):
+    def permutations(self, col_idx, num_perm, n_atoms, randomState=None):
         """
         This function takes a list of the columns that need permuting. It returns num_perm arrays of permuted indexes.
         It returns a numpy array where each row is a different permutation of the indexes. For example, if col_idx was:
@@ -444,22 +1335,287 @@ class CoulombMatrix():
 
         ``[[3 2 1 4 5], [2 1 3 4 5], [3 1 2 5 4]]``
 
+        All the permutations are drawn at once: each index gets a random key plus the number of its group, so sorting
+        the keys shuffles the indexes within each group and keeps the groups in order.
+
         :col_idx: list of list of columns' indexes that need permuting
         :num_perm: number of permutations desired (int)
         :n_atoms: total number of atoms in the system
+        :randomState: np.random.RandomState to draw the permutations from, the global np.random if None
         :return: an array of shape (num_perm, n_atoms) of permuted indexes.
         """
-        all_perm = np.zeros((num_perm, n_atoms), dtype=np.int8)
-        temp = col_idx
+        flat_idx = np.array([item for sublist in col_idx for item in sublist], dtype=np.intp)
+        groupNumber = np.repeat(np.arange(len(col_idx)), [len(sublist) for sublist in col_idx])
 
-        for j in range(num_perm):
-            for i in range(len(col_idx)):
-                temp[i] = np.random.permutation(col_idx[i])
-            flat_temp = [item for sublist in temp for item in sublist]
-            all_perm[j,:] = flat_temp
+        random = np.random if randomState is None else randomState
+        keys = random.random_sample((num_perm, flat_idx.shape[0])) + groupNumber
+        all_perm = flat_idx[np.argsort(keys, axis=-1)]
 
         return all_perm
 
+    def generate(self, descriptor, numRep=5):
+        """
+        This function returns one of the descriptors by name, without the energies. It is used by the functions that
+        split the work in blocks (streamDescriptor, generateParallel).
+
+        :descriptor: one of "CM", "ES", "SCM", "TriangCM", "RSCM" or "PRCM" (string)
+        :numRep: number of matrices generated per sample for "RSCM" and "PRCM" (int)
+        :return: numpy array of shape (n_samples*rowsPerSample, n_features) (see descriptorShape)
+        """
+        if descriptor == "CM":
+            return self.getCM()
+        elif descriptor == "ES":
+            return self.generateES()
+        elif descriptor == "SCM":
+            return self.generateSCM()
+        elif descriptor == "TriangCM":
+            return self.generateTriangCM()
+        elif descriptor == "RSCM":
+            return self.generateRSCM(np.zeros(self.n_samples), numRep=numRep)[0]
+        elif descriptor == "PRCM":
+            return self.generatePRCM(np.zeros(self.n_samples), numRep=numRep)[0]
+        raise ValueError("Error: unknown descriptor %s." % descriptor)
+
+    def generateDescriptors(self, descriptors, y_data=None, numRep=5, blockBytes=2**22):
+        """
+        This function generates several descriptors in a single pass over the samples, instead of one pass per generate
+        method. The Coulomb matrices of each block are gathered once and shared by all the descriptors, as are the norms
+        of their rows (SCM and RSCM) and the triangle indexes, and every result is written straight into its
+        preallocated output. The blocks are cut so that their temporary arrays take about blockBytes, small enough to
+        stay in the processor cache while all the descriptors of the block are computed.
+
+        The results are the same as those of the separate methods. With a single random descriptor ("RSCM" or "PRCM")
+        the random numbers drawn are the same too, while with both of them their draws are interleaved block by block.
+        With samples of different sizes, "PRCM" is generated by generatePRCM after the pass. As with the separate
+        methods, trimCM, coulS and coulES are kept, so that append extends them.
+
+        :descriptors: list of names among "CM", "ES", "SCM", "TriangCM", "RSCM" and "PRCM"
+        :y_data: energies of shape (n_samples,), only used for "RSCM" and "PRCM"
+        :numRep: number of matrices generated per sample for "RSCM" and "PRCM" (int)
+        :blockBytes: memory ceiling in bytes for the temporary arrays of one block (int)
+        :return: dictionary from the name of each descriptor to its numpy array (see descriptorShape for the shapes).
+            For "RSCM" and "PRCM", if y_data is given, a tuple of the array and the energies repeated to match its rows.
+        """
+        unknown = set(descriptors) - {"CM", "ES", "SCM", "TriangCM", "RSCM", "PRCM"}
+        if unknown:
+            raise ValueError("Error: unknown descriptor %s." % ", ".join(sorted(unknown)))
+        if "RSCM" in descriptors and (not isinstance(numRep, int) or numRep < 1):
+            raise ValueError("Error: the number of RSCM per sample has to be an integer larger than 0.")
+
+        n_triang = self.triangle[0].shape[0]
+        outputs = {}
+        if "TriangCM" in descriptors:
+            outputs["TriangCM"] = self.trimCM = np.zeros((self.n_samples, n_triang), dtype=self.dtype)
+        if "SCM" in descriptors:
+            outputs["SCM"] = self.coulS = np.zeros((self.n_samples, n_triang), dtype=self.dtype)
+        if "ES" in descriptors:
+            outputs["ES"] = self.coulES = np.zeros((self.n_samples, self.n_atoms), dtype=self.dtype)
+        if "RSCM" in descriptors:
+            outputs["RSCM"] = np.zeros((self.n_samples*numRep, n_triang), dtype=self.dtype)
+        prcm = None
+        if "PRCM" in descriptors and self.mask is None:
+            prcm = self.__prcmSetup(numRep)
+            outputs["PRCM"] = np.zeros((self.n_samples*prcm["n_out"], n_triang), dtype=self.dtype)
+
+        # Temporary arrays of one sample: its matrix and row norms, then what each descriptor adds
+        def bytesPerSample(n):
+            extra = {"TriangCM": 0.5 * n * (n+1), "SCM": 1.5 * n * (n+1) + n, "ES": 3 * n**2,
+                     "RSCM": numRep * (4 * n + 1.5 * n * (n+1)),
+                     "PRCM": 0 if prcm is None else prcm["n_out"] * (4 * n + 1.5 * n * (n+1))}
+            return 8 * (n**2 + n + sum(extra[name] for name in outputs))
+
+        for samples, size in self.__blocks(bytesPerSample, maxMemory=blockBytes):
+            if not outputs:
+                break
+            tempCM = self.__blockCM(samples, size)
+            mask = None if self.mask is None else self.mask[samples, :size]
+            positions = self.__triangPositions(size)
+
+            if "TriangCM" in outputs:
+                if self.packed:
+                    self.__store(outputs["TriangCM"], samples, slice(None), self.coulMatrix[samples])
+                else:
+                    self.__store(outputs["TriangCM"], samples, positions, self.trimAndFlat(tempCM))
+            if "ES" in outputs:
+                self.__store(outputs["ES"], samples, slice(0, size), self.__esBlock(tempCM, samples))
+            if "SCM" in outputs or "RSCM" in outputs:
+                rowNorms = self.__rowNorms(tempCM)
+                if "SCM" in outputs:
+                    self.__store(outputs["SCM"], samples, positions, self.__scmBlock(tempCM, rowNorms, mask))
+                if "RSCM" in outputs:
+                    result = self.__rscmBlock(tempCM, rowNorms, mask, numRep)
+                    self.__store(outputs["RSCM"], self.__replicaRows(samples, numRep), positions,
+                                 np.reshape(result, (-1, result.shape[-1])))
+            if "PRCM" in outputs:
+                result = self.__prcmBlock(tempCM, samples, prcm)
+                self.__store(outputs["PRCM"], self.__replicaRows(samples, prcm["n_out"]), slice(None),
+                             np.reshape(result, (-1, n_triang)))
+
+        if "CM" in descriptors:
+            outputs["CM"] = self.getCM()
+        if "PRCM" in descriptors and prcm is None:
+            outputs["PRCM"] = self.generatePRCM(np.zeros(self.n_samples), numRep=numRep)[0]
+
+        if y_data is not None:
+            for name in ("RSCM", "PRCM"):
+                if name in outputs:
+                    rowsPerSample = outputs[name].shape[0] // max(1, self.n_samples)
+                    outputs[name] = outputs[name], np.repeat(np.asarray(y_data, dtype=float), rowsPerSample)
+
+        return {name: outputs[name] for name in descriptors}
+
+    def generateParallel(self, descriptor, y_data=None, numRep=5, nWorkers=None, chunkSize=10000, seed=None):
+        """
+        This function generates a descriptor on several cores. The samples are split in shards of chunkSize samples that
+        are handed to a pool of nWorkers processes. The coordinates and the output are kept in shared memory, so that
+        no large array is pickled between the processes.
+
+        For "RSCM" and "PRCM" every shard seeds the random number generator from seed and its own index. The result
+        therefore only depends on seed and chunkSize, and not on the number of workers.
+
+        :descriptor: one of "CM", "ES", "SCM", "TriangCM", "RSCM" or "PRCM" (string)
+        :y_data: energies of shape (n_samples,), only used for "RSCM" and "PRCM"
+        :numRep: number of matrices generated per sample for "RSCM" and "PRCM" (int)
+        :nWorkers: number of processes, all the cores if None (int)
+        :chunkSize: number of samples in each shard (int)
+        :seed: seed of the random number generator for "RSCM" and "PRCM", a random one is drawn if None (int)
+        :return: numpy array of shape (n_rows, n_features) and, for "RSCM" and "PRCM", the energies repeated to match
+            the rows of the descriptor (numpy array of shape (n_rows,), None if y_data is None).
+        """
+        if self.labels is None:
+            raise ValueError("Error: generateParallel needs all the samples to have the same atoms in the same order.")
+
+        rowsPerSample, n_features = descriptorShape(descriptor, self.charges, numRep)
+        if seed is None:
+            seed = np.random.randint(2**31)
+        shards = [(start, min(start + chunkSize, self.n_samples)) for start in range(0, self.n_samples, chunkSize)]
+
+        outBytes = self.dtype.itemsize * self.n_samples * rowsPerSample * n_features
+        coordsShm = shared_memory.SharedMemory(create=True, size=max(1, self.coords.nbytes))
+        outShm = shared_memory.SharedMemory(create=True, size=max(1, outBytes))
+        try:
+            coords = np.ndarray(self.coords.shape, dtype=self.dtype, buffer=coordsShm.buf)
+            coords[:] = self.coords
+            out = np.ndarray((self.n_samples * rowsPerSample, n_features), dtype=self.dtype, buffer=outShm.buf)
+
+            layout = (coordsShm.name, self.coords.shape, outShm.name, out.shape, list(self.labels), self.maxMemory,
+                      self.packed, descriptor, numRep, rowsPerSample, seed, self.dtype.str)
+            tasks = [(shard, start, stop) for shard, (start, stop) in enumerate(shards)]
+
+            if nWorkers == 1:
+                # Running the shards in this process, without touching the state of the global random generator
+                randomState = np.random.get_state()
+                _attachShared(*layout)
+                for task in tasks:
+                    _generateShard(task)
+                np.random.set_state(randomState)
+            else:
+                with ProcessPoolExecutor(max_workers=nWorkers, initializer=_attachShared, initargs=layout) as pool:
+                    list(pool.map(_generateShard, tasks))
+
+            result = out.copy()
+            del coords, out
+        finally:
+            _sharedArrays.clear()
+            for shm in (coordsShm, outShm):
+                shm.close()
+                shm.unlink()
+
+        if descriptor in ("RSCM", "PRCM"):
+            y_big = None if y_data is None else np.repeat(np.asarray(y_data, dtype=float), rowsPerSample)
+            return result, y_big
+
+        return result
+
+    def iterateBatches(self, descriptor, y_data=None, batchSize=32, numRep=5, epochs=1, shuffle=True, seed=None,
+                       prefetch=2):
+        """
+        This function yields a descriptor in shuffled mini-batches, to train a model without building the whole
+        descriptor. The rows of each batch are generated from the stored Coulomb matrices when the batch is needed, so
+        "RSCM" and "PRCM" take the memory of one batch whatever numRep is. Each epoch goes once through the
+        n_samples*rowsPerSample rows (see descriptorShape) in a new order, and the rows of "RSCM" and "PRCM" get new
+        random sortings, so the model sees new augmented matrices in every epoch.
+
+        The batches are generated on a background thread, up to prefetch batches ahead of the caller, so that training
+        on one batch overlaps with generating the next ones (numpy and LAPACK release the GIL). The random numbers are
+        drawn from a np.random.RandomState of the iterator, the global np.random stream is left untouched.
+
+        :descriptor: one of "CM", "ES", "SCM", "TriangCM", "RSCM" or "PRCM" (string)
+        :y_data: energies of shape (n_samples,), None to only yield the descriptor
+        :batchSize: number of rows per batch, the last batch of an epoch can be smaller (int)
+        :numRep: number of matrices per sample and epoch for "RSCM" and "PRCM" (int)
+        :epochs: number of passes over the data, None to go on until the caller stops (int)
+        :shuffle: whether to shuffle the rows in each epoch (bool)
+        :seed: seed of the random numbers, a random one if None (int)
+        :prefetch: number of batches generated ahead, 0 to generate them on the calling thread (int)
+        :return: generator of (X_batch, y_batch), numpy arrays of shape (n_batch, n_features) and (n_batch,), y_batch is
+            None if y_data is None
+        """
+        if descriptor == "PRCM":
+            prcm = self.__prcmSetup(1)
+            rowsPerSample = min(numRep, prcm["n_perm"])
+        else:
+            prcm = None
+            rowsPerSample = descriptorShape(descriptor, np.zeros(self.n_atoms), numRep)[0]
+        if rowsPerSample < 1 or batchSize < 1:
+            raise ValueError("Error: numRep and batchSize have to be at least 1.")
+
+        y_data = None if y_data is None else np.asarray(y_data, dtype=float)
+        randomState = np.random.RandomState(seed)
+
+        def batches():
+            n_rows = self.n_samples * rowsPerSample
+            epoch = 0
+            while epochs is None or epoch < epochs:
+                order = randomState.permutation(n_rows) if shuffle else np.arange(n_rows)
+                for start in range(0, n_rows, batchSize):
+                    samples = order[start:start + batchSize] // rowsPerSample
+                    X_batch = self.__batchDescriptor(descriptor, samples, randomState, prcm)
+                    yield X_batch, None if y_data is None else y_data[samples]
+                epoch += 1
+
+        if prefetch:
+            return _prefetch(batches(), prefetch)
+        return batches()
+
+    def __batchDescriptor(self, descriptor, samples, randomState, prcm=None):
+        """
+        This function generates one row of a descriptor for each of a list of samples (see iterateBatches). The samples
+        can come in any order and more than once, each row of "RSCM" and "PRCM" gets its own random sorting.
+
+        :descriptor: one of "CM", "ES", "SCM", "TriangCM", "RSCM" or "PRCM" (string)
+        :samples: numpy array of sample indexes
+        :randomState: np.random.RandomState to draw the random sortings from
+        :prcm: settings of "PRCM" from __prcmSetup, with n_out = 1
+        :return: numpy array of shape (n_batch, n_features)
+        """
+        if descriptor == "TriangCM" and self.packed:
+            return self.coulMatrix[samples]
+
+        tempCM = self.__blockCM(samples, self.n_atoms)
+        mask = None if self.mask is None else self.mask[samples]
+
+        if descriptor == "CM":
+            return np.reshape(tempCM, (-1, self.n_atoms**2))
+        elif descriptor == "TriangCM":
+            return self.trimAndFlat(tempCM)
+        elif descriptor == "ES":
+            return self.__esBlock(tempCM, samples)
+        elif descriptor == "PRCM":
+            return self.__prcmBlock(tempCM, samples, prcm, randomState=randomState)[:, 0]
+        elif descriptor not in ("SCM", "RSCM"):
+            raise ValueError("Error: unknown descriptor %s." % descriptor)
+
+        # Sorted and randomly sorted matrices, the dummy atoms always come last
+        rowNorms = self.__rowNorms(tempCM)
+        if descriptor == "RSCM":
+            if mask is None:
+                scale = np.std(rowNorms, axis=-1)[:, np.newaxis]
+            else:
+                scale = np.std(rowNorms, axis=-1, where=mask)[:, np.newaxis]
+            rowNorms = rowNorms + randomState.normal(loc=0.0, scale=scale, size=rowNorms.shape)
+        return self.__scmBlock(tempCM, rowNorms, mask)
+
     def plot(self, X):
         """
         This function plots a Coulomb matrix as a heatmap.
@@ -474,4 +1630,296 @@ class CoulombMatrix():
         sns.plt.show()
 
 
+def streamDescriptor(coordFile, labels, outFile, descriptor="SCM", y_data=None, numRep=5, blockSize=10000,
+                     maxMemory=2**28, dtype=np.float64):
+    """
+    This function generates a descriptor for a data set that does not fit in memory. The geometries are read from a
+    memory-mapped .npy file (for example written with ``np.save(coordFile, geometrySet.coords)``) in blocks of blockSize
+    samples and the descriptor of each block is written straight into a preallocated .npy file opened as a np.memmap.
+    The peak memory used is therefore set by blockSize and not by the size of the data set.
+
+    :coordFile: .npy file with the coordinates, of shape (n_samples, n_atoms, 3) or (n_samples, 3*n_atoms) (string)
+    :labels: list of the atom labels of length n_atoms, shared by all the samples
+    :outFile: .npy file where the descriptor is written (string)
+    :descriptor: one of "CM", "ES", "SCM", "TriangCM", "RSCM" or "PRCM" (string)
+    :y_data: energies of shape (n_samples,), only used for "RSCM" and "PRCM"
+    :numRep: number of matrices generated per sample for "RSCM" and "PRCM" (int)
+    :blockSize: number of samples read from coordFile at a time (int)
+    :maxMemory: memory ceiling in bytes used when building the Coulomb matrices of a block (see batchCM)
+    :dtype: floating point type of the computation and of outFile (see CoulombMatrix)
+    :return: the descriptor as a np.memmap of shape (n_rows, n_features) and, for "RSCM" and "PRCM", the energies
+        repeated to match the rows of the descriptor (numpy array of shape (n_rows,), None if y_data is None).
+    """
+    coords = np.load(coordFile, mmap_mode='r')
+    n_samples = coords.shape[0]
+    rowsPerSample, n_features = descriptorShape(descriptor, [atomicCharges[label] for label in labels], numRep)
+
+    out = np.lib.format.open_memmap(outFile, mode='w+', dtype=dtype, shape=(n_samples*rowsPerSample, n_features))
+
+    for start in range(0, n_samples, blockSize):
+        stop = min(start + blockSize, n_samples)
+        block = CoulombMatrix(GeometrySet(np.asarray(coords[start:stop]), labels), maxMemory=maxMemory, dtype=dtype)
+        out[start*rowsPerSample:stop*rowsPerSample, :] = block.generate(descriptor, numRep=numRep)
+
+    out.flush()
+
+    if descriptor in ("RSCM", "PRCM"):
+        y_big = None if y_data is None else np.repeat(y_data, rowsPerSample)
+        return out, y_big
+
+    return out
+
+
+def compareDtypes(matrixX, descriptors=("CM", "TriangCM", "SCM", "ES"), dtype=np.float32, tolerance=1e-4,
+                  maxMemory=2**28):
+    """
+    This function measures how far the descriptors computed in a lower precision (see CoulombMatrix) are from the
+    float64 ones, e.g. to check a data set before training on float32 descriptors. For each descriptor it gives the
+    largest absolute error, the largest error of a row relative to the largest value of the float64 row, and the
+    fraction of rows whose relative error is above tolerance.
+
+    The relative errors of "CM", "TriangCM" and "ES" are those of the rounding, a few 1e-7 in float32. The sorted
+    matrices are as close, unless two rows of a Coulomb matrix have norms within rounding of each other and are sorted
+    in a different order: those samples show up in the fraction of rows above tolerance. The random descriptors cannot
+    be compared this way.
+
+    :matrixX: the geometries, in any format accepted by CoulombMatrix
+    :descriptors: names among "CM", "ES", "SCM" and "TriangCM"
+    :dtype: floating point type to check (np.float32 or np.float16)
+    :tolerance: relative error above which a row counts as different (float)
+    :maxMemory: memory ceiling in bytes used when building the Coulomb matrices (see batchCM)
+    :return: dictionary from the name of each descriptor to a dictionary with maxAbsError, maxRelError and
+        fractionAbove
+    """
+    if set(descriptors) - {"CM", "ES", "SCM", "TriangCM"}:
+        raise ValueError("Error: compareDtypes only compares the CM, ES, SCM and TriangCM descriptors.")
+
+    reference = CoulombMatrix(matrixX, maxMemory=maxMemory)
+    lower = CoulombMatrix(matrixX, maxMemory=maxMemory, dtype=dtype)
+
+    errors = {}
+    for descriptor in descriptors:
+        expected = reference.generate(descriptor)
+        error = np.abs(lower.generate(descriptor).astype(np.float64) - expected)
+        rowScale = np.maximum(np.max(np.abs(expected), axis=-1), np.finfo(np.float64).tiny)
+        rowError = np.max(error, axis=-1) / rowScale
+        errors[descriptor] = {"maxAbsError": float(error.max(initial=0.0)),
+                              "maxRelError": float(rowError.max(initial=0.0)),
+                              "fractionAbove": float(np.mean(rowError > tolerance)) if rowError.shape[0] else 0.0}
 
+    return errors
+
+
+class DescriptorCache():
+    """
+    This class keeps the descriptors that were already generated, so that generating the same descriptor for the same
+    geometries again (e.g. the same training set with other hyperparameters) only costs a look up. The descriptors are
+    found by a hash of their content: the coordinates, the nuclear charges of the atoms, the name of the descriptor,
+    numRep and the seed of the random number generator (see cachedDescriptor).
+
+    There are two tiers:
+
+    1. memory: the most recently used descriptors, up to memoryBytes bytes
+    2. disk: one .npy file per descriptor in directory, up to diskBytes bytes. The least recently used files are deleted
+       when the limit is exceeded. A descriptor found on disk is memory-mapped instead of being read, and kept with the
+       memory tier without counting towards memoryBytes, since its data stays in the file.
+
+    The arrays returned are read-only, since they are shared with the cache.
+
+    :directory: directory of the disk tier, created if needed, no disk tier if None (string)
+    :memoryBytes: size limit of the memory tier in bytes (int)
+    :diskBytes: size limit of the disk tier in bytes (int)
+    """
+
+    def __init__(self, directory=None, memoryBytes=2**28, diskBytes=2**32):
+
+        self.directory = directory
+        self.memoryBytes = memoryBytes
+        self.diskBytes = diskBytes
+        self.memory = collections.OrderedDict()
+        self.memoryUsed = 0
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, coords, charges, descriptor, numRep=None, seed=None, dtype=np.float64):
+        """
+        This function returns the key of a descriptor.
+
+        :coords: numpy array of the xyz coordinates of shape (n_samples, n_atoms, 3)
+        :charges: numpy array of the nuclear charges of shape (n_atoms,) or (n_samples, n_atoms)
+        :descriptor: name of the descriptor (string)
+        :numRep: number of matrices per sample for "RSCM" and "PRCM" (int)
+        :seed: seed of the random number generator for "RSCM" and "PRCM" (int)
+        :dtype: floating point type of the descriptor
+        :return: hexadecimal digest (string)
+        """
+        settings = (descriptor, numRep, seed, np.shape(coords), np.shape(charges))
+        if np.dtype(dtype) != np.float64:
+            settings += (np.dtype(dtype).str,)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr(settings).encode())
+        digest.update(np.ascontiguousarray(coords, dtype=float).tobytes())
+        digest.update(np.ascontiguousarray(charges, dtype=float).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        This function looks up a descriptor, first in memory and then on disk.
+
+        :key: key of the descriptor (string)
+        :return: read-only numpy array, or None if the descriptor is not in the cache
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        fileName = self.__fileName(key)
+        if fileName is not None and os.path.isfile(fileName):
+            try:
+                array = np.load(fileName, mmap_mode='r')
+            except (OSError, ValueError):
+                array = None
+            if array is not None:
+                # The modification time of the file is its last use, for the eviction
+                os.utime(fileName)
+                self.__remember(key, array)
+                self.hits += 1
+                return array
+
+        self.misses += 1
+        return None
+
+    def put(self, key, array):
+        """
+        This function adds a descriptor to the cache.
+
+        :key: key of the descriptor (string)
+        :array: numpy array
+        :return: the array as kept in the cache (read-only)
+        """
+        array = np.asarray(array)
+        fileName = self.__fileName(key)
+        if fileName is not None:
+            # Writing to a temporary file first so that an interrupted run never leaves a broken file behind
+            try:
+                with open(fileName + ".tmp", "wb") as cacheFile:
+                    np.save(cacheFile, array)
+                os.replace(fileName + ".tmp", fileName)
+                self.__evictDisk()
+            except OSError:
+                pass
+
+        array.flags.writeable = False
+        self.__remember(key, array)
+        return array
+
+    def clear(self):
+        """
+        This function empties both tiers of the cache.
+        """
+        self.memory.clear()
+        self.memoryUsed = 0
+        if self.directory is not None:
+            for fileName in os.listdir(self.directory):
+                if fileName.endswith(".npy"):
+                    os.remove(os.path.join(self.directory, fileName))
+
+    def __fileName(self, key):
+        return None if self.directory is None else os.path.join(self.directory, key + ".npy")
+
+    def __remember(self, key, array):
+        """
+        This function adds an array to the memory tier and drops the least recently used ones above memoryBytes.
+        """
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memoryUsed -= self.__memoryBytes(old)
+        if self.__memoryBytes(array) > self.memoryBytes:
+            return
+        self.memory[key] = array
+        self.memoryUsed += self.__memoryBytes(array)
+        while self.memoryUsed > self.memoryBytes:
+            self.memoryUsed -= self.__memoryBytes(self.memory.popitem(last=False)[1])
+
+    @staticmethod
+    def __memoryBytes(array):
+        """
+        This function returns the memory used by an array of the memory tier, none for a memory-mapped file.
+        """
+        return 0 if isinstance(array, np.memmap) else array.nbytes
+
+    def __evictDisk(self):
+        """
+        This function deletes the least recently used files of the disk tier above diskBytes.
+        """
+        files = []
+        for fileName in os.listdir(self.directory):
+            if fileName.endswith(".npy"):
+                fileStat = os.stat(os.path.join(self.directory, fileName))
+                files.append((fileStat.st_mtime_ns, fileStat.st_size, fileName))
+
+        used = sum(size for mtime, size, fileName in files)
+        for mtime, size, fileName in sorted(files):
+            if used <= self.diskBytes:
+                break
+            os.remove(os.path.join(self.directory, fileName))
+            used -= size
+
+
+def cachedDescriptor(matrixX, descriptor, cache, y_data=None, numRep=5, seed=None, maxMemory=2**28, dtype=np.float64):
+    """
+    This function generates a descriptor through a DescriptorCache: the Coulomb matrices are only built if the
+    descriptor is not in the cache yet.
+
+    "RSCM" and "PRCM" are random, so they are only cached when a seed is given. The global random number generator is
+    then seeded with it for the generation, and its state is restored afterwards.
+
+    :matrixX: the geometries, in any format accepted by CoulombMatrix
+    :descriptor: one of "CM", "ES", "SCM", "TriangCM", "RSCM" or "PRCM" (string)
+    :cache: DescriptorCache
+    :y_data: energies of shape (n_samples,), only used for "RSCM" and "PRCM"
+    :numRep: number of matrices generated per sample for "RSCM" and "PRCM" (int)
+    :seed: seed of the random number generator for "RSCM" and "PRCM" (int)
+    :maxMemory: memory ceiling in bytes used when building the Coulomb matrices (see batchCM)
+    :dtype: floating point type of the descriptor (see CoulombMatrix)
+    :return: the descriptor (read-only numpy array) and, for "RSCM" and "PRCM", the energies repeated to match the
+        rows of the descriptor (numpy array, None if y_data is None)
+    """
+    if not isinstance(matrixX, (GeometrySet, PaddedGeometrySet)):
+        try:
+            matrixX = GeometrySet.fromList(matrixX)
+        except ValueError:
+            # Samples of different sizes or compositions
+            matrixX = PaddedGeometrySet.fromList(matrixX)
+
+    isRandom = descriptor in ("RSCM", "PRCM")
+    key = None
+    result = None
+    if not isRandom or seed is not None:
+        key = cache.key(matrixX.coords, matrixX.charges, descriptor, numRep if isRandom else None, seed, dtype)
+        result = cache.get(key)
+
+    if result is None:
+        coulMat = CoulombMatrix(matrixX, maxMemory=maxMemory, dtype=dtype)
+        if isRandom and seed is not None:
+            randomState = np.random.get_state()
+            np.random.seed(seed)
+            try:
+                result = coulMat.generate(descriptor, numRep=numRep)
+            finally:
+                np.random.set_state(randomState)
+        else:
+            result = coulMat.generate(descriptor, numRep=numRep)
+        if key is not None:
+            result = cache.put(key, result)
+
+    if isRandom:
+        rowsPerSample = result.shape[0] // max(1, matrixX.n_samples)
+        y_big = None if y_data is None else np.repeat(np.asarray(y_data, dtype=float), rowsPerSample)
+        return result, y_big
+
+    return result
@@ -0,0 +1,245 @@
+"""
+Module for recording the frames sent to the Unity renderer to a binary log, and replaying them.
+
+A frame log starts with LOG_MAGIC, the length of a json header as a little endian uint32 and the header itself,
+{"labels": [...], "sizes": [...]} like the schema message of the binary protocol (see AvatarServer.FrameSchema), padded
+with spaces to a multiple of 4 bytes. Then come the records, appended as the frames are sent: one row of width + 1
+little endian float32 per frame, the time in seconds since the start of the recording followed by the values of the
+frame, slot after slot. The records can be memory mapped as an array of shape (n_frames, width + 1).
+"""
+
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from AvatarServer import FrameEncoder, FrameSchema
+
+LOG_MAGIC = b"AVLOG001"
+LOG_HEADER_LENGTH = struct.Struct("<I")
+
+
+def read_log_header(file_name):
+    """
+    Reads the header of a frame log.
+    :param file_name: Path of the log.
+    :return: The FrameSchema of the log and the offset of the first record in bytes.
+    """
+    with open(file_name, "rb") as log_file:
+        magic = log_file.read(len(LOG_MAGIC))
+        if magic != LOG_MAGIC:
+            raise ValueError("%s is not a frame log." % file_name)
+        header_length, = LOG_HEADER_LENGTH.unpack(log_file.read(LOG_HEADER_LENGTH.size))
+        header = json.loads(log_file.read(header_length).decode('utf-8'))
+    return FrameSchema(header["labels"], header["sizes"]), len(LOG_MAGIC) + LOG_HEADER_LENGTH.size + header_length
+
+
+def log_header(schema):
+    """
+    Generates the header of a frame log.
+    :param schema: The FrameSchema of the frames.
+    :return: The bytes of the header.
+    """
+    header = json.dumps({"labels": schema.labels, "sizes": schema.sizes}, separators=(',', ':')).encode('utf-8')
+    header += b" " * (-(len(LOG_MAGIC) + LOG_HEADER_LENGTH.size + len(header)) % 4)
+    return LOG_MAGIC + LOG_HEADER_LENGTH.pack(len(header)) + header
+
+
+class FrameRecorder:
+    """
+    Writes frames to a frame log. Give it to an AvatarServer to record every frame the server sends, or call record
+    directly.
+
+    A log holds frames of a single schema. If the file already exists, the new frames are appended to it, and their
+    times carry on from the last record.
+    """
+
+    def __init__(self, file_name):
+        """
+        Opens (or creates, on the first frame) the log.
+        :param file_name: Path of the log.
+        """
+        self.file_name = file_name
+        self.log_file = None
+        self.schema = None
+        self.n_frames = 0
+        self.start_time = None
+
+        if os.path.exists(file_name) and os.path.getsize(file_name) > 0:
+            self.schema, offset = read_log_header(file_name)
+            record_size = 4 * (self.schema.width + 1)
+            self.n_frames = (os.path.getsize(file_name) - offset) // record_size
+            self.log_file = open(file_name, "r+b")
+            # A record cut short (e.g. by a crash) would shift all the following ones
+            self.log_file.truncate(offset + self.n_frames * record_size)
+            last_time = 0.0
+            if self.n_frames > 0:
+                self.log_file.seek(offset + (self.n_frames - 1) * record_size)
+                last_time = float(np.frombuffer(self.log_file.read(4), dtype='<f4')[0])
+            self.log_file.seek(0, os.SEEK_END)
+            self.start_time = time.perf_counter() - last_time
+
+    def record(self, schema, values):
+        """
+        Appends frames to the log, all with the current time.
+        :param schema: The FrameSchema of the values.
+        :param values: Array of shape (width,) or (n_frames, width), in the slot order of the schema.
+        :return:
+        """
+        if self.log_file is None:
+            self.schema = schema
+            self.log_file = open(self.file_name, "wb")
+            self.log_file.write(log_header(schema))
+            self.start_time = time.perf_counter()
+        elif schema is not self.schema:
+            if schema.labels != self.schema.labels or schema.sizes != self.schema.sizes:
+                raise ValueError("A frame log can only hold frames of a single schema.")
+            self.schema = schema
+
+        values = np.asarray(values).reshape(-1, schema.width)
+        records = np.empty((values.shape[0], schema.width + 1), dtype='<f4')
+        records[:, 0] = time.perf_counter() - self.start_time
+        records[:, 1:] = values
+        self.log_file.write(records.tobytes())
+        self.n_frames += values.shape[0]
+
+    def record_dictionary(self, dictionary):
+        """
+        Appends a frame dictionary (e.g. from generate_message) to the log.
+        :param dictionary: The dictionary of values.
+        :return:
+        """
+        schema = self.schema
+        if schema is None or not schema.matches(dictionary):
+            schema = FrameSchema.from_dictionary(dictionary)
+        self.record(schema, schema.dictionary_values(dictionary))
+
+    def flush(self):
+        """
+        Writes the buffered records to the file, so that they can be read while recording.
+        :return:
+        """
+        if self.log_file is not None:
+            self.log_file.flush()
+
+    def close(self):
+        """
+        Writes the buffered records and closes the file.
+        :return:
+        """
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+class FrameLog:
+    """
+    Read only, memory mapped view of a frame log.
+    """
+
+    def __init__(self, file_name):
+        """
+        Maps the records of a log.
+        :param file_name: Path of the log.
+        """
+        self.file_name = file_name
+        self.schema, offset = read_log_header(file_name)
+        width = self.schema.width + 1
+        n_frames = (os.path.getsize(file_name) - offset) // (4 * width)
+        if n_frames > 0:
+            self.records = np.memmap(file_name, dtype='<f4', mode='r', offset=offset, shape=(n_frames, width))
+        else:
+            self.records = np.empty((0, width), dtype='<f4')
+        self.times = self.records[:, 0]
+        self.values = self.records[:, 1:]
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    def frame_index(self, seconds):
+        """
+        :param seconds: Time since the start of the recording.
+        :return: Index of the first frame recorded at or after this time.
+        """
+        return int(np.searchsorted(self.times, seconds, side='left'))
+
+
+class FrameLogReplayer:
+    """
+    Streams a frame log back to the client of an AvatarServer, in the protocol of the client, at the recorded speed,
+    a multiple of it, or as fast as possible.
+
+    Frames are sent in batches of memory mapped rows with AvatarServer.send_values: at the recorded speed, every batch
+    holds the frames that are due, so frames recorded together are sent together.
+    """
+
+    def __init__(self, log, server, max_batch=64):
+        """
+        Prepares the replay from the start of the log.
+        :param log: FrameLog, or path of the log.
+        :param server: The AvatarServer to send the frames with, with a client connected.
+        :param max_batch: Largest number of frames sent in one socket call.
+        """
+        self.log = log if isinstance(log, FrameLog) else FrameLog(log)
+        self.server = server
+        self.max_batch = max_batch
+        self.encoder = FrameEncoder.from_schema(self.log.schema)
+        self.position = 0
+
+    def seek(self, frame=None, seconds=None):
+        """
+        Moves the replay to a frame, or to the first frame recorded at or after a time.
+        :param frame: Index of the frame, negative values count from the end.
+        :param seconds: Time since the start of the recording, used if frame is None.
+        :return: The new position.
+        """
+        if frame is None:
+            frame = self.log.frame_index(seconds)
+        elif frame < 0:
+            frame += len(self.log)
+        self.position = min(max(frame, 0), len(self.log))
+        return self.position
+
+    def play(self, speed=1.0, stop=None, verbose=False):
+        """
+        Sends the frames from the current position.
+        :param speed: Replay speed, 1.0 for the recorded speed, 2.0 for twice as fast, etc. None or 0 sends the frames as
+        fast as possible.
+        :param stop: Index of the frame to stop at (excluded), defaults to the end of the log.
+        :param verbose: if True, prints the number of frames sent and the achieved frame rate at the end.
+        :return: dictionary with the number of frames and socket calls, the duration and the achieved fps
+        """
+        times = self.log.times
+        values = self.log.values
+        stop = len(self.log) if stop is None else min(stop, len(self.log))
+        start = self.position
+        stats = {"frames": 0, "sends": 0, "duration": 0.0, "fps": 0.0}
+        if start >= stop:
+            return stats
+
+        first_time = float(times[start])
+        start_time = time.perf_counter()
+        while self.position < stop:
+            end = min(self.position + self.max_batch, stop)
+            if speed:
+                delay = (float(times[self.position]) - first_time) / speed - (time.perf_counter() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+                now = first_time + (time.perf_counter() - start_time) * speed
+                due = int(np.searchsorted(times[self.position:end], now, side='right'))
+                end = self.position + max(due, 1)
+
+            self.server.send_values(self.encoder, values[self.position:end])
+            if self.server.clientsocket is None:
+                break
+            stats["sends"] += 1
+            self.position = end
+
+        stats["frames"] = self.position - start
+        stats["duration"] = time.perf_counter() - start_time
+        stats["fps"] = stats["frames"] / stats["duration"] if stats["duration"] > 0 else 0.0
+        if verbose:
+            print(("Replayed %d frames, %.1f fps" % (stats["frames"], stats["fps"])))
+        return stats
@@ -2,8 +2,39 @@
 Module for transmitting avatar data to the Unity renderer.
 """
 
+import asyncio
 import json
 import socket
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+# Binary protocol: every message is a header (payload length as uint32, message type as uint8) followed by the payload.
+MESSAGE_HEADER = struct.Struct("<IB")
+# Payload is a json schema {"labels": [...], "sizes": [...]} mapping each label to a slot of sizes[i] floats.
+MESSAGE_SCHEMA = 0
+# Payload is the float32 values of all the slots of the current schema, in order.
+MESSAGE_FRAME = 1
+# Delta protocol: payload is the int32 values of all the slots, quantized at the scale given in the schema.
+MESSAGE_KEYFRAME = 2
+# Delta protocol: payload is the int16 differences between the quantized values and those of the previous frame.
+MESSAGE_DELTA = 3
+# Flag added to the message type when the payload is compressed with zlib. The integers of the payload are first split
+# in byte planes (the first byte of every integer, then the second byte, ...), which compress much better than the
+# interleaved bytes. All the compressed payloads of a connection belong to one deflate stream, flushed with
+# Z_SYNC_FLUSH after each message and without the 00 00 ff ff trailer of the flush, so that each frame is compressed
+# against the previous ones.
+MESSAGE_ZLIB = 0x80
+# Lines sent by a client straight after connecting to ask for the binary or the delta protocol. The server replies with
+# the same line.
+BINARY_HANDSHAKE = b'{"protocol":"binary"}\n'
+DELTA_HANDSHAKE = b'{"protocol":"delta"}\n'
+DELTA_ZLIB_HANDSHAKE = b'{"protocol":"delta","compression":"zlib"}\n'
+# End of every Z_SYNC_FLUSH block, left out of the messages
+ZLIB_SYNC_TRAILER = b"\x00\x00\xff\xff"
 
 
 def generate_labels_full(feature_labels, target_labels):
@@ -39,7 +70,8 @@ def generate_labels_for_target(target_label, quaternion=False):
     return ["{0}{1}".format(target_label, coord) for coord in coords]
 
 
-def send_data_to_render(server, features, targets, targets_predicted,feature_labels_full,target_labels_full, pred_labels_full ):
+def send_data_to_render(server, features, targets, targets_predicted,feature_labels_full,target_labels_full, pred_labels_full,
+                        quaternions=None, quaternion_labels=None):
     """
     Sends data to the specified server to render
     :param server: server to send data to
@@ -49,15 +81,96 @@ def send_data_to_render(server, features, targets, targets_predicted,feature_lab
     :param feature_labels_full: feature labels
     :param target_labels_full: target labels
     :param pred_labels_full: predicted data labels
+    :param quaternions: optional quaternions to render, of shape (n_frames, len(quaternion_labels), 4)
+    :param quaternion_labels: labels the quaternions match, e.g. ["LController", "RController", "Headset"]
     :return: returns nothing
     """
-    for f, t, p in zip(features, targets, targets_predicted):
-        message = generate_message(f, feature_labels_full,t, target_labels_full,p, pred_labels_full)
-        server.send_object(message)
+    encoder = FrameEncoder(feature_labels_full, target_labels_full, pred_labels_full, 
+                           quaternion_labels=quaternion_labels)
+    if quaternions is None:
+        for f, t, p in zip(features, targets, targets_predicted):
+            server.send_frame(encoder, f, t, p)
+    else:
+        for f, t, p, q in zip(features, targets, targets_predicted, quaternions):
+            server.send_frame(encoder, f, t, p, q)
     return
 
 
-def generate_message(f, feature_labels_full,t, target_labels_full,p, pred_labels_full):
+def stream_data_to_render(server, features, targets, targets_predicted, feature_labels_full, target_labels_full,
+                          pred_labels_full, fps=90.0, frames_per_send=None, batch_size=1024, verbose=False,
+                          quaternions=None, quaternion_labels=None):
+    """
+    Streams data to the specified server to render, paced to a target frame rate.
+
+    The frames are encoded batch_size at a time with a FrameEncoder, and frames_per_send consecutive frames are handed
+    to the socket in a single (scatter/gather) call. Between calls the function sleeps until the next frame is due,
+    so replaying a long recording in real time does not keep a core busy. If sending falls behind schedule it 
+    catches up without sleeping.
+
+    :param server: server to send data to
+    :param features: feature data to render, of shape (n_frames, n_features)
+    :param targets: target data to render, of shape (n_frames, n_targets)
+    :param targets_predicted: predicted data to render, of shape (n_frames, n_targets)
+    :param feature_labels_full: feature labels
+    :param target_labels_full: target labels
+    :param pred_labels_full: predicted data labels
+    :param fps: target frame rate, None to send as fast as possible
+    :param frames_per_send: number of frames per socket call, defaults to about 30 calls per second (64 frames 
+    per call without pacing)
+    :param batch_size: number of frames encoded at a time
+    :param verbose: if True, prints the achieved frame rate and backlog after each batch
+    :param quaternions: optional quaternions to render, of shape (n_frames, len(quaternion_labels), 4)
+    :param quaternion_labels: labels the quaternions match, e.g. ["LController", "RController", "Headset"]
+    :return: dictionary with the number of frames and socket calls, the duration, the achieved fps, and the final and
+    largest backlog (number of frames that were due but not sent yet)
+    """
+    encoder = FrameEncoder(feature_labels_full, target_labels_full, pred_labels_full, 
+                           quaternion_labels=quaternion_labels)
+    n_frames = len(features)
+    if frames_per_send is None:
+        frames_per_send = max(1, int(fps // 30)) if fps else 64
+
+    stats = {"frames": 0, "sends": 0, "duration": 0.0, "fps": 0.0, "backlog": 0, "max_backlog": 0}
+    start_time = time.perf_counter()
+
+    for batch_start in range(0, n_frames, batch_size):
+        batch_stop = min(batch_start + batch_size, n_frames)
+        q = None if quaternions is None else quaternions[batch_start:batch_stop]
+        # The values of a batch are computed at once, then sent a few frames at a time
+        frames = encoder.values(features[batch_start:batch_stop], targets[batch_start:batch_stop],
+                                targets_predicted[batch_start:batch_stop], q)
+
+        for i in range(0, batch_stop - batch_start, frames_per_send):
+            frame = batch_start + i
+            if fps:
+                delay = start_time + frame / fps - time.perf_counter()
+                if delay > 0:
+                    stats["backlog"] = 0
+                    time.sleep(delay)
+                else:
+                    backlog = int(-delay * fps)
+                    stats["backlog"] = backlog
+                    stats["max_backlog"] = max(stats["max_backlog"], backlog)
+
+            server.send_values(encoder, frames[i:i + frames_per_send])
+            if server.clientsocket is None:
+                break
+
+            stats["sends"] += 1
+            stats["frames"] = min(frame + frames_per_send, batch_stop)
+
+        stats["duration"] = time.perf_counter() - start_time
+        stats["fps"] = stats["frames"] / stats["duration"] if stats["duration"] > 0 else 0.0
+        if verbose:
+            print(("Sent %d frames, %.1f fps, backlog of %d frames" % (stats["frames"], stats["fps"], 
+                                                                       stats["backlog"])))
+        if server.clientsocket is None:
+            break
+
+    return stats
+
+
+def generate_message(f, feature_labels_full,t, target_labels_full,p, pred_labels_full, q=None, quaternion_labels=None):
     """
     Generates a message that is sent to the renderer from input data to be rendered.
     :param f: feature data to be rendered
@@ -66,13 +179,19 @@ def generate_message(f, feature_labels_full,t, target_labels_full,p, pred_labels
     :param target_labels_full: labels for target data
     :param p: predicted target data to be rendered
     :param pred_labels_full: labels for predicted data
+    :param q: optional quaternions to be rendered, of shape (len(quaternion_labels), 4)
+    :param quaternion_labels: labels the quaternions match, e.g. ["LController", "RController", "Headset"]
     :return: a dictionary containing the message to be sent to the renderer
     """
     # The 1.5 factor is just a last minute scaling fixi
     feature_dict = generate_dictionary_for_data(f*1.5, feature_labels_full)
     target_dict = generate_dictionary_for_data(t*1.5, target_labels_full)
     pred_dict = generate_dictionary_for_data(p*1.5, pred_labels_full)
-    return merge_dictionaries(feature_dict, target_dict, pred_dict)
+    message = merge_dictionaries(feature_dict, target_dict, pred_dict)
+    if quaternion_labels:
+        for quaternion, label in zip(q, quaternion_labels):
+            message = add_quaternion_to_message(message, quaternion, label)
+    return message
 
 
 def add_quaternion_to_message(dictionary, quaternion, label):
@@ -127,6 +246,247 @@ def merge_dictionaries(*dict_args):
     return result
 
 
+def frame_message(message_type, payload):
+    """
+    Frames a payload for the binary protocol.
+    :param message_type: MESSAGE_SCHEMA or MESSAGE_FRAME.
+    :param payload: The bytes to be sent.
+    :return: The header followed by the payload.
+    """
+    return MESSAGE_HEADER.pack(len(payload), message_type) + payload
+
+
+class FrameSchema:
+    """
+    Layout of the frames of the binary protocol: the labels of a frame dictionary, in order, each mapped to a slot of
+    one float (a scalar) or several floats (a vector).
+
+    A schema message is sent once, then every frame only carries the float32 values of the slots.
+    """
+
+    def __init__(self, labels, sizes):
+        """
+        Creates a schema.
+
+        :param labels: List of labels, one per slot.
+        :param sizes: List with the number of floats of each slot.
+        """
+        self.labels = list(labels)
+        self.sizes = list(sizes)
+        self.width = sum(self.sizes)
+
+    @classmethod
+    def from_dictionary(cls, dictionary):
+        """
+        Creates the schema matching a frame dictionary, e.g. as returned by generate_message.
+
+        :param dictionary: Dictionary of labels to floats or lists of floats.
+        :return: The schema.
+        """
+        sizes = [len(value) if isinstance(value, (list, tuple, np.ndarray)) else 1 for value in dictionary.values()]
+        return cls(dictionary.keys(), sizes)
+
+    def matches(self, dictionary):
+        """
+        Indicates whether a frame dictionary has the labels and slot sizes of this schema.
+
+        :param dictionary: Dictionary of labels to floats or lists of floats.
+        :return: True if the dictionary can be encoded with this schema.
+        """
+        if list(dictionary.keys()) != self.labels:
+            return False
+        sizes = [len(value) if isinstance(value, (list, tuple, np.ndarray)) else 1 for value in dictionary.values()]
+        return sizes == self.sizes
+
+    def schema_message(self, scale=None):
+        """
+        :param scale: Quantization scale of the delta protocol, added to the schema if given.
+        :return: The framed schema message.
+        """
+        schema = {"labels": self.labels, "sizes": self.sizes}
+        if scale is not None:
+            schema["scale"] = scale
+        payload = json.dumps(schema, separators=(',', ':')).encode('utf-8')
+        return frame_message(MESSAGE_SCHEMA, payload)
+
+    def dictionary_values(self, dictionary):
+        """
+        Lays out the values of a frame dictionary matching this schema in one flat array, slot after slot.
+
+        :param dictionary: Dictionary of labels to floats or lists of floats.
+        :return: Array of length width.
+        """
+        values = np.empty(self.width)
+        i = 0
+        for value, size in zip(dictionary.values(), self.sizes):
+            values[i:i + size] = value
+            i += size
+        return values
+
+    def encode_values(self, values):
+        """
+        Encodes a flat array of values, laid out slot after slot, into a framed message.
+
+        :param values: Array of length width.
+        :return: The framed frame message.
+        """
+        return frame_message(MESSAGE_FRAME, np.asarray(values, dtype='<f4').tobytes())
+
+    def encode_dictionary(self, dictionary):
+        """
+        Encodes a frame dictionary matching this schema into a framed message.
+
+        :param dictionary: Dictionary of labels to floats or lists of floats.
+        :return: The framed frame message.
+        """
+        return self.encode_values(self.dictionary_values(dictionary))
+
+
+class DeltaFrameCodec:
+    """
+    Encoder of the delta protocol. Consecutive frames barely change, so the values are quantized to integers (by 
+    default at 4 decimals, the precision of PrettyFloat) and only the int16 differences with the previous frame are 
+    sent. A keyframe with all the int32 quantized values is sent every keyframe_interval frames, and whenever a 
+    difference does not fit in an int16. The payloads can also be compressed with zlib, in a single stream for the
+    connection (see MESSAGE_ZLIB), so that each frame is compressed against the previous ones.
+
+    Since the differences are taken between quantized values, the rounding errors do not build up.
+    """
+
+    def __init__(self, keyframe_interval=90, compression=None, scale=10000):
+        """
+        Creates a codec.
+
+        :param keyframe_interval: Number of frames between two keyframes.
+        :param compression: None, or "zlib" to compress the payloads.
+        :param scale: The values are sent as integers of value * scale.
+        """
+        self.keyframe_interval = keyframe_interval
+        self.compression = compression
+        self.scale = scale
+        self.compressor = zlib.compressobj() if compression == "zlib" else None
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous frame, so that the next one is a keyframe. The compression stream carries on, since the
+        client decompresses all the messages of the connection in order.
+        """
+        self.previous = None
+        self.frame_count = 0
+
+    def encode(self, values):
+        """
+        Encodes the values of one frame.
+        :param values: Array of length width.
+        :return: The framed keyframe or delta message.
+        """
+        quantized = np.round(np.asarray(values, dtype=float) * self.scale).astype(np.int64)
+        delta = None if self.previous is None else quantized - self.previous
+        if (delta is None or self.frame_count % self.keyframe_interval == 0 or
+                np.any(np.abs(delta) > np.iinfo(np.int16).max)):
+            message_type = MESSAGE_KEYFRAME
+            payload = quantized.astype('<i4').tobytes()
+        else:
+            message_type = MESSAGE_DELTA
+            payload = delta.astype('<i2').tobytes()
+
+        self.previous = quantized
+        self.frame_count += 1
+        if self.compressor is not None:
+            itemsize = 4 if message_type == MESSAGE_KEYFRAME else 2
+            payload = np.frombuffer(payload, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+            payload = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            return frame_message(message_type | MESSAGE_ZLIB, payload[:-len(ZLIB_SYNC_TRAILER)])
+        return frame_message(message_type, payload)
+
+
+class BinaryFrameDecoder:
+    """
+    Decodes the binary protocol on the client side. Feed it the bytes received from the server and it returns the
+    frames as dictionaries, in the same format as the json protocol.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.schema = None
+        self.scale = None
+        self.previous = None
+        self.decompressor = zlib.decompressobj()
+
+    def feed(self, data):
+        """
+        Adds received bytes and decodes all the complete messages.
+
+        :param data: Bytes received from the server.
+        :return: List of frame dictionaries.
+        """
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= MESSAGE_HEADER.size:
+            length, message_type = MESSAGE_HEADER.unpack_from(self.buffer)
+            end = MESSAGE_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = self.buffer[MESSAGE_HEADER.size:end]
+            self.buffer = self.buffer[end:]
+
+            if message_type & MESSAGE_ZLIB:
+                message_type &= ~MESSAGE_ZLIB
+                payload = self.decompressor.decompress(payload + ZLIB_SYNC_TRAILER)
+                # Back from byte planes to integers
+                itemsize = 4 if message_type == MESSAGE_KEYFRAME else 2
+                payload = np.frombuffer(payload, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+            if message_type == MESSAGE_SCHEMA:
+                schema = json.loads(payload.decode('utf-8'))
+                self.schema = FrameSchema(schema["labels"], schema["sizes"])
+                self.scale = schema.get("scale")
+            elif message_type == MESSAGE_FRAME:
+                frames.append(self.decode_values(np.frombuffer(payload, dtype='<f4')))
+            elif message_type == MESSAGE_KEYFRAME:
+                self.previous = np.frombuffer(payload, dtype='<i4').astype(np.int64)
+                frames.append(self.decode_values(self.previous / self.scale))
+            elif message_type == MESSAGE_DELTA:
+                if self.previous is None:
+                    raise ValueError("Received a delta frame before a keyframe.")
+                self.previous = self.previous + np.frombuffer(payload, dtype='<i2')
+                frames.append(self.decode_values(self.previous / self.scale))
+        return frames
+
+    def decode_values(self, values):
+        """
+        Turns the values of a frame into a dictionary using the current schema.
+
+        :param values: Array of length schema.width.
+        :return: Dictionary with labels and values.
+        """
+        if self.schema is None:
+            raise ValueError("Received a frame before the schema.")
+        dictionary = {}
+        i = 0
+        for label, size in zip(self.schema.labels, self.schema.sizes):
+            dictionary[label] = float(values[i]) if size == 1 else [float(v) for v in values[i:i + size]]
+            i += size
+        return dictionary
+
+
+def parse_handshake(line, keyframe_interval=90):
+    """
+    Works out the protocol asked for by a client from the line it sent after connecting.
+    :param line: The bytes received, BINARY_HANDSHAKE, DELTA_HANDSHAKE, DELTA_ZLIB_HANDSHAKE or anything else for json.
+    :param keyframe_interval: Number of frames between two keyframes for the delta protocol.
+    :return: The protocol ("json", "binary" or "delta") and, for the delta protocol, a new DeltaFrameCodec.
+    """
+    if line == BINARY_HANDSHAKE:
+        return "binary", None
+    elif line == DELTA_HANDSHAKE:
+        return "delta", DeltaFrameCodec(keyframe_interval)
+    elif line == DELTA_ZLIB_HANDSHAKE:
+        return "delta", DeltaFrameCodec(keyframe_interval, compression="zlib")
+    return "json", None
+
+
 def generate_dictionary_for_data(data_row, labels):
     """
     Generates a dictionary for a given row of data and labels. 
@@ -164,6 +524,143 @@ def generate_dictionary_for_data(data_row, labels):
     return dictionary
 
 
+class FrameEncoder:
+    """
+    Encoder for the frames built by generate_message, compiled once for a set of labels.
+
+    The labels do not change within a session, so the grouping of the X, Y, Z (and W) columns into vectors is worked 
+    out once here, with generate_dictionary_for_data, together with a json template and a FrameSchema for the binary 
+    protocol. A row of features, targets and predictions (or a whole batch of them) is then turned into wire bytes 
+    with one gather, one scaling and one string formatting or tobytes call, without building any dictionary.
+
+    The json frames have the same labels and values as send_object(generate_message(...)), but the floats are always 
+    written with 4 decimals (e.g. 1.0000 instead of 1.0).
+    """
+
+    def __init__(self, feature_labels_full, target_labels_full, pred_labels_full, scale=1.5, quaternion_labels=None):
+        """
+        Compiles the encoder.
+
+        :param feature_labels_full: labels for feature data, as returned by generate_labels_full
+        :param target_labels_full: labels for target data
+        :param pred_labels_full: labels for predicted data
+        :param scale: factor applied to all the values but the quaternions, 1.5 like in generate_message
+        :param quaternion_labels: labels of the quaternions sent with every frame, e.g. ["LController", "Headset"].
+        Like with add_quaternion_to_message, they are sent as "LControllerQuaternion", ... after the other values, 
+        and are not scaled.
+        """
+        self.scale = scale
+        self.quaternion_labels = list(quaternion_labels) if quaternion_labels else []
+        quaternion_labels_full = [label for quaternion_label in self.quaternion_labels
+                                  for label in generate_labels_for_target(quaternion_label + "Quaternion", True)]
+        self.sizes = [len(feature_labels_full), len(target_labels_full), len(pred_labels_full), 
+                      len(quaternion_labels_full)]
+
+        # Using the column indexes as data gives, for every label, the columns that make it up
+        layout = {}
+        offset = 0
+        for labels in (feature_labels_full, target_labels_full, pred_labels_full, quaternion_labels_full):
+            layout.update(generate_dictionary_for_data(list(range(offset, offset + len(labels))), labels))
+            offset += len(labels)
+
+        columns = []
+        slot_sizes = []
+        template = []
+        for label, value in layout.items():
+            if isinstance(value, list):
+                columns.extend(int(column) for column in value)
+                slot_sizes.append(len(value))
+                template.append('"%s":[%s]' % (label, ','.join(['%.4f'] * len(value))))
+            else:
+                columns.append(value)
+                slot_sizes.append(1)
+                template.append('"%s":%%.4f' % label)
+
+        self.columns = np.array(columns, dtype=np.intp)
+        self.scales = np.where(self.columns < sum(self.sizes[:3]), scale, 1.0)
+        self.schema = FrameSchema(layout.keys(), slot_sizes)
+        self.json_template = '{' + ','.join(template) + '}\n'
+        self.frame_header = MESSAGE_HEADER.pack(4 * self.schema.width, MESSAGE_FRAME)
+
+    @classmethod
+    def from_schema(cls, schema):
+        """
+        Creates an encoder for values already laid out in the slot order of a schema (e.g. read back from a frame log),
+        to be sent with AvatarServer.send_values.
+
+        :param schema: The FrameSchema of the values.
+        :return: The encoder, with no gather and no scaling.
+        """
+        labels = []
+        for label, size in zip(schema.labels, schema.sizes):
+            labels.extend(generate_labels_for_target(label, quaternion=size == 4) if size > 1 else [label])
+        encoder = cls(labels, [], [], scale=1.0)
+        if encoder.schema.labels != schema.labels or encoder.schema.sizes != schema.sizes:
+            raise ValueError("The schema cannot be rebuilt from its labels.")
+        encoder.schema = schema
+        return encoder
+
+    def values(self, f, t, p, q=None):
+        """
+        Gathers and scales the values of frames in the slot order of the schema.
+        :param f: feature data, of shape (n_features,) or (n_frames, n_features)
+        :param t: target data, of shape (n_targets,) or (n_frames, n_targets)
+        :param p: predicted data, of shape (n_targets,) or (n_frames, n_targets)
+        :param q: quaternions, of shape (n_quaternions, 4) or (n_frames, n_quaternions, 4), if the encoder has 
+        quaternion labels
+        :return: array of shape (width,) or (n_frames, width)
+        """
+        data = [np.asarray(f, dtype=float), np.asarray(t, dtype=float), np.asarray(p, dtype=float)]
+        if self.quaternion_labels:
+            if q is None:
+                raise ValueError("Quaternions are needed for %s." % ", ".join(self.quaternion_labels))
+            q = np.asarray(q, dtype=float)
+            data.append(q.reshape(q.shape[:-2] + (self.sizes[3],)))
+        row = np.concatenate(data, axis=-1)
+        return row[..., self.columns] * self.scales
+
+    def encode_json(self, f, t, p, q=None):
+        """
+        Encodes one frame as a json line.
+        :return: The bytes to be sent.
+        """
+        return (self.json_template % tuple(self.values(f, t, p, q).tolist())).encode('ascii')
+
+    def encode_binary(self, f, t, p, q=None):
+        """
+        Encodes one frame as a binary frame message (the schema message has to be sent first).
+        :return: The bytes to be sent.
+        """
+        return self.frame_header + self.values(f, t, p, q).astype('<f4').tobytes()
+
+    def encode_batch(self, features, targets, targets_predicted, protocol="json", quaternions=None):
+        """
+        Encodes a batch of frames.
+        :param features: feature data of shape (n_frames, n_features)
+        :param targets: target data of shape (n_frames, n_targets)
+        :param targets_predicted: predicted data of shape (n_frames, n_targets)
+        :param protocol: "json" or "binary"
+        :param quaternions: quaternions of shape (n_frames, n_quaternions, 4), if the encoder has quaternion labels
+        :return: List of the bytes of each frame.
+        """
+        values = self.values(features, targets, targets_predicted, quaternions)
+        if protocol == "binary":
+            return [frame.tobytes() for frame in self.binary_block(values)]
+        return [(self.json_template % tuple(row)).encode('ascii') for row in values.tolist()]
+
+    def binary_block(self, values):
+        """
+        Lays out the binary frame messages of a batch in one contiguous array.
+        :param values: Array of shape (n_frames, width), as returned by values.
+        :return: Array of bytes of shape (n_frames, frame size), each row is one frame message.
+        """
+        header = np.frombuffer(self.frame_header, dtype=np.uint8)
+        block = np.empty((values.shape[0], header.shape[0] + 4 * self.schema.width), dtype=np.uint8)
+        block[:, :header.shape[0]] = header
+        block[:, header.shape[0]:] = np.ascontiguousarray(values, dtype='<f4').view(np.uint8)
+        return block
+
+
 class AvatarServer:
     """
     Class for transmitting avatar data to a client, using json strings.
@@ -214,19 +711,40 @@ class AvatarServer:
     
     The method generate_dictionary_for_data in the module avatarServer can be used to generate a python dictionary 
     for a list of data. See AvatarServerTest.py for an example of sending features and targets. 
+
+    Clients can opt in to a compact binary protocol by sending BINARY_HANDSHAKE straight after connecting. The server
+    replies with the same line, then sends a schema message (see FrameSchema) followed by frames of float32 values, 
+    each prefixed by MESSAGE_HEADER. A new schema is sent whenever the labels of the frames change. Clients that do 
+    not send the handshake get the json strings above. BinaryFrameDecoder decodes the binary protocol.
+
+    Clients sending DELTA_HANDSHAKE (or DELTA_ZLIB_HANDSHAKE) get the delta protocol instead: the same schema, then 
+    quantized keyframes and deltas (see DeltaFrameCodec), which use several times less bandwidth.
+
+    Sessions can be recorded to a frame log by giving the server a FrameRecorder, and replayed later with a 
+    FrameLogReplayer (see AvatarRecorder).
     """
 
-    def __init__(self, host="localhost", port=54321):
+    def __init__(self, host="localhost", port=54321, handshake_timeout=0.5, keyframe_interval=90, recorder=None):
         """
         Initialises the avatar socket server. 
         
         :param host: IP address to connect to, defaults to localhost. 
         :param port: Port to connect to. 
+        :param handshake_timeout: Time in seconds to wait for a client to ask for the binary protocol after connecting.
+        Set to 0 to always use json.
+        :param keyframe_interval: Number of frames between two keyframes for the delta protocol.
+        :param recorder: Optional FrameRecorder (see AvatarRecorder) that every frame sent is written to.
         """
         self.host = host
         self.port = port
+        self.handshake_timeout = handshake_timeout
+        self.keyframe_interval = keyframe_interval
+        self.recorder = recorder
         self.clientsocket = None
         self.clientaddr = None
+        self.protocol = "json"
+        self.schema = None
+        self.codec = None
         self.socket = None
         self.initialise_server(host, port)
 
@@ -253,17 +771,58 @@ class AvatarServer:
         print("Waiting for client to connect...")
         self.clientsocket, self.clientaddr = self.socket.accept()
         print(("Got a connection from %s" % str(self.clientaddr)))
+        self.schema = None
+        self.protocol, self.codec = self.negotiate_protocol()
         return self.clientsocket
 
+    def negotiate_protocol(self):
+        """
+        Waits up to handshake_timeout seconds for the client to ask for the binary or the delta protocol.
+        :return: The protocol ("json", "binary" or "delta") and, for the delta protocol, its DeltaFrameCodec.
+        """
+        if self.handshake_timeout <= 0:
+            return "json", None
+        received = b""
+        self.clientsocket.settimeout(self.handshake_timeout)
+        try:
+            while not received.endswith(b"\n") and len(received) < len(DELTA_ZLIB_HANDSHAKE):
+                data = self.clientsocket.recv(len(DELTA_ZLIB_HANDSHAKE) - len(received))
+                if not data:
+                    break
+                received += data
+        except socket.timeout:
+            pass
+        finally:
+            self.clientsocket.settimeout(None)
+
+        protocol, codec = parse_handshake(received, self.keyframe_interval)
+        if protocol != "json":
+            self.clientsocket.sendall(received)
+        return protocol, codec
+
     def is_connected(self):
         """
-        Indicates whether the avatar server is connected to a client.
+        Indicates whether the avatar server is connected to a client. The socket is polled without blocking, so a 
+        client that has disconnected is detected (and the connection closed) even before the next send fails.
         :return: True if a client is connected, False otherwise. 
         """
         if self.clientsocket is None:
             return False
-        # TODO make connection testing more robust.
-        return True
+        try:
+            self.clientsocket.setblocking(False)
+            closed = self.clientsocket.recv(1, socket.MSG_PEEK) == b""
+        except BlockingIOError:
+            # Nothing to read, but the connection is still open
+            closed = False
+        except socket.error:
+            closed = True
+        finally:
+            if self.clientsocket is not None:
+                self.clientsocket.setblocking(True)
+
+        if closed:
+            self.close_connection()
+        return not closed
 
     def close_connection(self):
         """
@@ -273,29 +832,557 @@ class AvatarServer:
         if self.clientsocket is None:
             return
         print(("Closing connection with %s" % str(self.clientaddr)))
-        self.clientsocket.shutdown(socket.SHUT_RDWR)
+        try:
+            self.clientsocket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # The client may already have closed its end
+            pass
         self.clientsocket.close()
         self.clientsocket = None
+        self.schema = None
+        self.codec = None
 
 
     def send_object(self, dictionary, verbose=False):
         """
-        Sends an object over the connection, by serializing it to json. 
+        Sends an object over the connection, by serializing it to json, or to a binary frame if the client negotiated
+        the binary protocol.
         :param dictionary: The dictionary of values to be sent. 
         :return: 
         """
         if self.clientsocket is None:
             raise ValueError("No client connected.")
+        if self.recorder is not None:
+            self.recorder.record_dictionary(dictionary)
+
+        if self.protocol != "json":
+            message = b""
+            if self.schema is None or not self.schema.matches(dictionary):
+                self.schema = FrameSchema.from_dictionary(dictionary)
+                message = self.schema_message()
+            if self.protocol == "delta":
+                message += self.codec.encode(self.schema.dictionary_values(dictionary))
+            else:
+                message += self.schema.encode_dictionary(dictionary)
+            if verbose:
+                print(("Transmitting binary frame of %d bytes" % len(message)))
+            self.send_bytes(message)
+            return
+
         json_obj = json.dumps(pretty_floats(dictionary), separators=(',',':')) + "\n"
         if verbose:
             print(("Transmitting string", json_obj))
 
+        self.send_bytes(json_obj.encode('ascii'))
+
+    def send_frame(self, encoder, f, t, p, q=None):
+        """
+        Sends a frame of features, targets and predictions using a FrameEncoder, in the protocol of the client.
+        :param encoder: The FrameEncoder matching the labels of the data.
+        :param f: feature data to be rendered
+        :param t: target data to be rendered
+        :param p: predicted target data to be rendered
+        :param q: quaternions to be rendered, of shape (n_quaternions, 4), if the encoder has quaternion labels
+        :return: 
+        """
+        if self.recorder is not None:
+            self.recorder.record(encoder.schema, encoder.values(f, t, p, q))
+        if self.protocol == "json":
+            self.send_bytes(encoder.encode_json(f, t, p, q))
+            return
+
+        if self.protocol == "delta":
+            message = self.codec.encode(encoder.values(f, t, p, q))
+        else:
+            message = encoder.encode_binary(f, t, p, q)
+        if self.schema is not encoder.schema:
+            self.schema = encoder.schema
+            message = self.schema_message() + message
+        self.send_bytes(message)
+
+    def schema_message(self):
+        """
+        Generates the schema message for the current schema and protocol. For the delta protocol the codec restarts 
+        with a keyframe, since the slots may have changed.
+        :return: The framed schema message.
+        """
+        if self.protocol == "delta":
+            self.codec.reset()
+            return self.schema.schema_message(scale=self.codec.scale)
+        return self.schema.schema_message()
+
+    def send_values(self, encoder, values):
+        """
+        Sends a batch of frames, already gathered and scaled with FrameEncoder.values, in a single socket call.
+        :param encoder: The FrameEncoder that produced the values.
+        :param values: Array of shape (n_frames, width).
+        :return: 
+        """
+        if self.recorder is not None:
+            self.recorder.record(encoder.schema, values)
+        if self.protocol == "json":
+            self.send_many([(encoder.json_template % tuple(row)).encode('ascii') for row in values.tolist()])
+            return
+
+        buffers = []
+        if self.schema is not encoder.schema:
+            self.schema = encoder.schema
+            buffers.append(self.schema_message())
+        if self.protocol == "delta":
+            buffers.extend(self.codec.encode(row) for row in values)
+        else:
+            buffers.append(encoder.binary_block(values))
+        self.send_many(buffers)
+
+    def send_many(self, buffers):
+        """
+        Sends several already encoded buffers over the connection, with as few system calls as possible (a 
+        scatter/gather sendmsg where available).
+        :param buffers: List of bytes-like objects to be sent, in order.
+        :return: 
+        """
+        if self.clientsocket is None:
+            raise ValueError("No client connected.")
+        if not hasattr(self.clientsocket, "sendmsg"):
+            self.send_bytes(b"".join(buffers))
+            return
+
+        buffers = [memoryview(buffer).cast('B') for buffer in buffers]
         try:
-            self.clientsocket.sendall(json_obj.encode('ascii'))
+            while buffers:
+                # sendmsg takes at most IOV_MAX buffers and can send only part of the data
+                sent = self.clientsocket.sendmsg(buffers[:512])
+                while buffers and sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                if buffers and sent:
+                    buffers[0] = buffers[0][sent:]
         except socket.error as err:
             print(("Error trying to transmit: " + str(err)))
             print("Will now close connection...")
             self.close_connection()
 
+    def send_bytes(self, data):
+        """
+        Sends already encoded data over the connection. 
+        :param data: The bytes to be sent.
+        :return: 
+        """
+        if self.clientsocket is None:
+            raise ValueError("No client connected.")
+        try:
+            self.clientsocket.sendall(data)
+        except socket.error as err:
+            print(("Error trying to transmit: " + str(err)))
+            print("Will now close connection...")
+            self.close_connection()
+
+
+class AsyncAvatarServer:
+    """
+    Avatar server for any number of clients (e.g. the renderer, a recorder and a monitoring dashboard), run by an 
+    asyncio event loop on a background thread.
+
+    Each published frame is encoded once per protocol in use (json and/or binary, see AvatarServer) and handed to 
+    every client. Frames for delta clients are encoded by each client's own DeltaFrameCodec when they are written.
+    Every client has its own bounded queue: when a slow client falls behind, its oldest queued frames are dropped
+    instead of stalling the producer or the other clients.
+    """
+
+    def __init__(self, host="localhost", port=54321, queue_size=8, handshake_timeout=0.5):
+        """
+        Starts the server and its event loop thread. Clients can connect straight away.
+
+        :param host: IP address to listen on, defaults to localhost.
+        :param port: Port to listen on.
+        :param queue_size: Number of frames that can wait for a slow client before the oldest are dropped.
+        :param handshake_timeout: Time in seconds to wait for a client to ask for the binary protocol.
+        """
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.handshake_timeout = handshake_timeout
+        self.clients = []
+        self.dropped_frames = 0
+        self.schema = None
+        # The tasks serving the clients, including those still negotiating their protocol
+        self.tasks = set()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle_client, host, port), self.loop).result()
+
+    def is_connected(self):
+        """
+        Indicates whether at least one client is connected. Clients are removed as soon as their connection closes.
+        :return: True if a client is connected, False otherwise. 
+        """
+        return len(self.clients) > 0
+
+    def wait_for_clients(self, n_clients=1, timeout=None):
+        """
+        Blocks until at least n_clients clients are connected (and their protocol negotiated).
+        :param n_clients: Number of clients to wait for.
+        :param timeout: Time in seconds to wait for, None to wait forever.
+        :return: True if the clients are connected, False if the timeout expired.
+        """
+        end = None if timeout is None else time.perf_counter() + timeout
+        while len(self.clients) < n_clients:
+            if end is not None and time.perf_counter() > end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def publish(self, dictionary):
+        """
+        Sends a frame dictionary (e.g. from generate_message) to all the clients, without blocking.
+        :param dictionary: The dictionary of values to be sent. 
+        :return: 
+        """
+        clients = list(self.clients)
+        json_frame = binary_frame = values = schema = None
+        if any(client.protocol == "json" for client in clients):
+            json_frame = (json.dumps(pretty_floats(dictionary), separators=(',', ':')) + "\n").encode('ascii')
+        if any(client.protocol != "json" for client in clients):
+            # The same schema object is passed on as long as the labels do not change, so that the clients only get a
+            # schema message when they do
+            if self.schema is None or not self.schema.matches(dictionary):
+                self.schema = FrameSchema.from_dictionary(dictionary)
+            schema = self.schema
+            values = schema.dictionary_values(dictionary)
+        if any(client.protocol == "binary" for client in clients):
+            binary_frame = schema.encode_values(values)
+        self.loop.call_soon_threadsafe(self._fan_out, clients, (schema, json_frame, binary_frame, values))
+
+    def publish_frame(self, encoder, f, t, p, q=None):
+        """
+        Sends a frame of features, targets and predictions to all the clients using a FrameEncoder, without blocking.
+        :param encoder: The FrameEncoder matching the labels of the data.
+        :param f: feature data to be rendered
+        :param t: target data to be rendered
+        :param p: predicted target data to be rendered
+        :param q: quaternions to be rendered, of shape (n_quaternions, 4), if the encoder has quaternion labels
+        :return: 
+        """
+        clients = list(self.clients)
+        json_frame = binary_frame = values = None
+        if any(client.protocol == "json" for client in clients):
+            json_frame = encoder.encode_json(f, t, p, q)
+        if any(client.protocol == "binary" for client in clients):
+            binary_frame = encoder.encode_binary(f, t, p, q)
+        if any(client.protocol == "delta" for client in clients):
+            values = encoder.values(f, t, p, q)
+        self.loop.call_soon_threadsafe(self._fan_out, clients, (encoder.schema, json_frame, binary_frame, values))
+
+    def close(self):
+        """
+        Disconnects all the clients, stops the server and its event loop thread.
+        :return: 
+        """
+        async def shutdown():
+            self.server.close()
+            # A client that stopped reading would keep its task waiting to write forever
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def _fan_out(self, clients, frame):
+        """
+        Queues a frame for clients, on the event loop thread. The oldest frame is dropped when a queue is full.
+        """
+        for client in clients:
+            if client.queue.full():
+                client.queue.get_nowait()
+                client.dropped_frames += 1
+                self.dropped_frames += 1
+            client.queue.put_nowait(frame)
+
+    async def _handle_client(self, reader, writer):
+        """
+        Serves one client: negotiates the protocol, then writes its queued frames until it disconnects.
+        """
+        client = _AsyncClient(reader, writer, self.queue_size)
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        watcher = getter = None
+        try:
+            try:
+                hello = await asyncio.wait_for(reader.readline(), self.handshake_timeout)
+            except asyncio.TimeoutError:
+                hello = b""
+            client.protocol, client.codec = parse_handshake(hello)
+            if client.protocol != "json":
+                writer.write(hello)
+            elif reader.at_eof():
+                return
 
+            self.clients.append(client)
+            print(("Got a connection from %s" % str(writer.get_extra_info('peername'))))
 
+            # The connection is closed when the client disconnects, whatever it sends in the meantime
+            watcher = asyncio.ensure_future(self._watch_client(reader))
+            while not watcher.done():
+                getter = asyncio.ensure_future(client.queue.get())
+                await asyncio.wait([getter, watcher], return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    break
+                schema, json_frame, binary_frame, values = getter.result()
+                if client.protocol == "json":
+                    writer.write(json_frame)
+                    await writer.drain()
+                    continue
+
+                if client.schema is not schema:
+                    client.schema = schema
+                    if client.protocol == "delta":
+                        client.codec.reset()
+                        writer.write(schema.schema_message(scale=client.codec.scale))
+                    else:
+                        writer.write(schema.schema_message())
+                if client.protocol == "delta":
+                    # Encoded here, against the last frame actually sent to this client, since frames may be dropped
+                    writer.write(client.codec.encode(values))
+                else:
+                    writer.write(binary_frame)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        except asyncio.CancelledError:
+            # Closing the server: the frames still waiting to be written are dropped. The task ends normally, since
+            # asyncio retrieves the exception of the tasks serving the connections.
+            writer.transport.abort()
+        finally:
+            self.tasks.discard(task)
+            pending = [future for future in (watcher, getter) if future is not None and not future.done()]
+            for future in pending:
+                future.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            if client in self.clients:
+                self.clients.remove(client)
+                print(("Closing connection with %s" % str(writer.get_extra_info('peername'))))
+            writer.close()
+
+    @staticmethod
+    async def _watch_client(reader):
+        """
+        Reads (and ignores) whatever the client sends until it disconnects, or the connection is reset.
+        """
+        try:
+            while await reader.read(1024):
+                pass
+        except (ConnectionError, OSError):
+            pass
+
+
+class _AsyncClient:
+    """
+    State of one client of AsyncAvatarServer.
+    """
+
+    def __init__(self, reader, writer, queue_size):
+        self.reader = reader
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.protocol = "json"
+        self.codec = None
+        self.schema = None
+        self.dropped_frames = 0
+
+
+class FrameRingBuffer:
+    """
+    Preallocated ring buffer of float32 rows, shared by one producer thread and one consumer thread.
+
+    The producer and the consumer each only advance their own counter (rows written and rows read), so putting and 
+    getting rows takes no lock. When the buffer is full, the overflow policy decides what happens:
+
+    "drop_oldest": the producer overwrites the oldest rows, which the consumer then counts as dropped.
+    "block": the producer waits for the consumer to make room.
+    """
+
+    def __init__(self, capacity, width, overflow="drop_oldest"):
+        """
+        Allocates the buffer.
+
+        :param capacity: Maximum number of rows held.
+        :param width: Number of floats per row.
+        :param overflow: "drop_oldest" or "block".
+        """
+        if overflow not in ("drop_oldest", "block"):
+            raise ValueError("Unknown overflow policy %s." % overflow)
+        self.rows = np.zeros((capacity, width), dtype=np.float32)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.write_count = 0
+        self.read_count = 0
+        self.dropped = 0
+        # Only used to sleep when there is nothing to do, not to protect the counters
+        self._data_ready = threading.Event()
+        self._space_ready = threading.Event()
+
+    def __len__(self):
+        return min(self.write_count - self.read_count, self.capacity)
+
+    def put(self, row, timeout=None):
+        """
+        Adds a row, from the producer thread.
+        :param row: Array of width values.
+        :param timeout: With the "block" policy, the longest time in seconds to wait for room, None to wait forever.
+        :return: True if the row was added, False if the timeout expired.
+        """
+        if self.overflow == "block":
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self.write_count - self.read_count >= self.capacity:
+                self._space_ready.clear()
+                if self.write_count - self.read_count < self.capacity:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None and remaining <= 0) or not self._space_ready.wait(remaining):
+                    return False
+
+        self.rows[self.write_count % self.capacity] = row
+        self.write_count += 1
+        if not self._data_ready.is_set():
+            self._data_ready.set()
+        return True
+
+    def get_batch(self, max_rows, timeout=None):
+        """
+        Takes up to max_rows of the oldest rows, from the consumer thread.
+        :param max_rows: Maximum number of rows returned.
+        :param timeout: Longest time in seconds to wait for a row, None to wait forever.
+        :return: Array of shape (n_rows, width), a copy of the rows. It is empty if the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.write_count == self.read_count:
+            self._data_ready.clear()
+            if self.write_count != self.read_count:
+                break
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if (remaining is not None and remaining <= 0) or not self._data_ready.wait(remaining):
+                return self.rows[:0].copy()
+
+        # Skipping the rows that have already been overwritten
+        written = self.write_count
+        if written - self.read_count > self.capacity:
+            self.dropped += written - self.capacity - self.read_count
+            self.read_count = written - self.capacity
+
+        start = self.read_count
+        n_rows = min(max_rows, written - start)
+        indexes = np.arange(start, start + n_rows) % self.capacity
+        batch = self.rows[indexes]
+
+        # Rows the producer may have overwritten while they were being copied are dropped as well
+        lost = max(0, min(n_rows, self.write_count - self.capacity - start))
+        self.dropped += lost
+        self.read_count = start + n_rows
+        if not self._space_ready.is_set():
+            self._space_ready.set()
+        return batch[lost:]
+
+
+class BackgroundSender:
+    """
+    Sends frames to an AvatarServer from a dedicated thread, so that a model predicting live only pays for copying a 
+    row into a FrameRingBuffer: serialization and socket writes (and network hiccups) happen on the sender thread.
+    """
+
+    def __init__(self, server, encoder, capacity=1024, overflow="drop_oldest", max_batch=64):
+        """
+        Starts the sender thread.
+
+        :param server: AvatarServer with a connected client.
+        :param encoder: FrameEncoder matching the labels of the data.
+        :param capacity: Number of frames the ring buffer holds.
+        :param overflow: What to do when the buffer is full, "drop_oldest" or "block" (see FrameRingBuffer).
+        :param max_batch: Largest number of frames sent in one socket call.
+        """
+        self.server = server
+        self.encoder = encoder
+        self.max_batch = max_batch
+        self.buffer = FrameRingBuffer(capacity, sum(encoder.sizes), overflow)
+        self.sent_frames = 0
+        self.unsent_frames = 0
+        self._row = np.zeros(sum(encoder.sizes), dtype=np.float32)
+        self._running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def dropped_frames(self):
+        """
+        :return: The number of frames dropped, because the ring buffer was full or because no client was connected to
+        send them to.
+        """
+        return self.buffer.dropped + self.unsent_frames
+
+    def publish(self, f, t, p, timeout=None, q=None):
+        """
+        Queues a frame of features, targets and predictions for sending.
+        :param f: feature data to be rendered
+        :param t: target data to be rendered
+        :param p: predicted target data to be rendered
+        :param timeout: With the "block" policy, the longest time in seconds to wait for room, None to wait forever.
+        :param q: quaternions to be rendered, of shape (n_quaternions, 4), if the encoder has quaternion labels
+        :return: True if the frame was queued, False if the timeout expired.
+        """
+        n_f, n_t, n_p = self.encoder.sizes[:3]
+        self._row[:n_f] = f
+        self._row[n_f:n_f + n_t] = t
+        self._row[n_f + n_t:n_f + n_t + n_p] = p
+        if self.encoder.quaternion_labels:
+            if q is None:
+                raise ValueError("Quaternions are needed for %s." % ", ".join(self.encoder.quaternion_labels))
+            self._row[n_f + n_t + n_p:] = np.ravel(q)
+        return self.buffer.put(self._row, timeout)
+
+    def close(self, flush=True, timeout=5.0):
+        """
+        Stops the sender thread.
+        :param flush: If True, waits (up to timeout seconds) for the queued frames to be sent first.
+        :param timeout: Longest time in seconds to wait for the queued frames.
+        :return: 
+        """
+        end = time.perf_counter() + timeout
+        while flush and len(self.buffer) > 0 and self.thread.is_alive() and time.perf_counter() < end:
+            time.sleep(0.001)
+        self._running = False
+        self.thread.join()
+
+    def _run(self):
+        """
+        Body of the sender thread: drains the ring buffer, encodes and sends the frames.
+        """
+        n_f, n_t, n_p = self.encoder.sizes[:3]
+        n_q = len(self.encoder.quaternion_labels)
+        while self._running:
+            batch = self.buffer.get_batch(self.max_batch, timeout=0.05)
+            if batch.shape[0] == 0:
+                continue
+            if self.server.clientsocket is None:
+                self.unsent_frames += batch.shape[0]
+                continue
+            q = batch[:, n_f + n_t + n_p:].reshape(-1, n_q, 4) if n_q else None
+            values = self.encoder.values(batch[:, :n_f], batch[:, n_f:n_f + n_t], batch[:, n_f + n_t:n_f + n_t + n_p], q)
+            try:
+                self.server.send_values(self.encoder, values)
+            except ValueError:
+                # The client disconnected since the check above
+                if self.server.clientsocket is not None:
+                    raise
+            # A failed send closes the connection
+            if self.server.clientsocket is None:
+                self.unsent_frames += batch.shape[0]
+            else:
+                self.sent_frames += batch.shape[0]
@@ -0,0 +1,237 @@
+"""
+Module for converting the SteamVR recordings (data/*_steamVRPositions_*_labelled.csv) into a single columnar store.
+
+The csv files are read once, in chunks, and written to store_dir/data.npy, an array of shape (n_rows, n_labels) in
+column major order, so that every column is contiguous and the whole array can be memory mapped. The rows of a
+session, and the sessions of a subject, are contiguous, so the data of one subject or session is a slice of the memory
+map, without any copy. store_dir/index.json holds the labels of the columns and the rows of every session and subject.
+
+The columns are named like generate_labels_for_target does in AvatarServer: LControllerX, LControllerY,
+LControllerZ, ... for the positions and LControllerQuaternionX, ..., LControllerQuaternionW for the quaternions,
+whatever the order of the columns in the csv files.
+"""
+
+import datetime
+import json
+import os
+import re
+
+import numpy as np
+
+from AvatarServer import generate_labels_for_target
+
+# Tracked devices and body targets recorded in the csv files, in the order of the columns of the store
+POSITION_GROUPS = ['LController', 'RController', 'Headset', 'LeftElbow', 'RightElbow', 'Front', 'Back', 'LeftKnee',
+                   'RightKnee']
+QUATERNION_GROUPS = ['LController', 'RController', 'Headset']
+OTHER_COLUMNS = ['Scale', 'MainPlayerID']
+
+FILE_NAME_PATTERN = re.compile(r"(?P<subject>[^_]+)_steamVRPositions_(?P<session>.+)_labelled\.csv$")
+# Sessions are named after the time they were recorded, on a 12 hour clock
+SESSION_TIME_FORMAT = "%Y-%m-%d_%I-%M-%S-%p"
+
+
+def group_labels(group, quaternion=False):
+    """
+    :param group: Name of a tracked device or body target, e.g. LController.
+    :param quaternion: if True, the labels of the quaternion of the group instead of its position.
+    :return: The labels of the columns of the group.
+    """
+    if quaternion:
+        return generate_labels_for_target(group + "Quaternion", quaternion=True)
+    return generate_labels_for_target(group)
+
+
+def store_labels():
+    """
+    :return: The labels of the columns of a store, in order.
+    """
+    labels = []
+    for group in POSITION_GROUPS:
+        labels.extend(group_labels(group))
+    for group in QUATERNION_GROUPS:
+        labels.extend(group_labels(group, quaternion=True))
+    return labels + OTHER_COLUMNS
+
+
+def parse_file_name(file_name):
+    """
+    :param file_name: Path of a recording, e.g. data/felix_steamVRPositions_2017-04-28_01-36-18-PM_labelled.csv
+    :return: The subject and session of the recording, e.g. felix and 2017-04-28_01-36-18-PM.
+    """
+    match = FILE_NAME_PATTERN.match(os.path.basename(file_name))
+    if match is None:
+        raise ValueError("%s is not named like a SteamVR recording." % file_name)
+    return match.group("subject"), match.group("session")
+
+
+def session_time(session):
+    """
+    :param session: Name of a session, e.g. 2017-04-28_01-36-18-PM.
+    :return: The time the session was recorded, or None if the name is not a time.
+    """
+    try:
+        return datetime.datetime.strptime(session, SESSION_TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def recording_order(recording):
+    """
+    :param recording: The (subject, session) of a recording and its file name, as sorted by ingest_steamvr_csv.
+    :return: Sort key putting the sessions of a subject in chronological order, then the sessions whose name is not a
+    time.
+    """
+    (subject, session), file_name = recording
+    recorded = session_time(session)
+    return subject, recorded is None, recorded or datetime.datetime.min, session, file_name
+
+
+def is_incomplete(line):
+    """
+    :param line: A line of a csv file.
+    :return: True if some of the fields of the line are empty.
+    """
+    line = line.rstrip(b"\r\n")
+    return b",," in line or line.endswith(b",") or line.startswith(b",")
+
+
+def ingest_steamvr_csv(file_names, store_dir, chunk_rows=4096, drop_incomplete=True):
+    """
+    Converts SteamVR recordings into a store, reading chunk_rows lines of a file at a time.
+
+    :param file_names: Paths of the csv files, e.g. glob.glob('data/*_steamVRPositions_*').
+    :param store_dir: Directory to write the store to. It is created if needed, and an existing store is overwritten.
+    :param chunk_rows: Number of lines parsed at a time.
+    :param drop_incomplete: if True, the rows with missing values are left out, like df.dropna() does.
+    :return: The SteamVRStore.
+    """
+    labels = store_labels()
+    # Sessions of the same subject next to each other, in chronological order
+    recordings = sorted(((parse_file_name(file_name), file_name) for file_name in file_names), key=recording_order)
+
+    # First pass: count the rows, to allocate the store
+    n_rows = []
+    for _, file_name in recordings:
+        with open(file_name, "rb") as csv_file:
+            csv_file.readline()
+            n_rows.append(sum(1 for line in csv_file
+                              if line.strip() and not (drop_incomplete and is_incomplete(line))))
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    data = np.lib.format.open_memmap(os.path.join(store_dir, "data.npy"), mode='w+', dtype=np.float64,
+                                     shape=(sum(n_rows), len(labels)), fortran_order=True)
+
+    # Second pass: parse the files chunk by chunk, straight into the store
+    sessions = []
+    row = 0
+    for ((subject, session), file_name), n_file_rows in zip(recordings, n_rows):
+        with open(file_name, "rb") as csv_file:
+            header = csv_file.readline().decode('utf-8').strip().split(',')
+            missing = [label for label in labels if label not in header]
+            if missing:
+                raise ValueError("%s has no column %s." % (file_name, ", ".join(missing)))
+            use_cols = [header.index(label) for label in labels]
+
+            start = row
+            chunk = []
+            for line in csv_file:
+                if line.strip() and not (drop_incomplete and is_incomplete(line)):
+                    chunk.append(line)
+                if len(chunk) == chunk_rows:
+                    data[row:row + len(chunk)] = np.genfromtxt(chunk, delimiter=',', usecols=use_cols, ndmin=2)
+                    row += len(chunk)
+                    chunk = []
+            if chunk:
+                data[row:row + len(chunk)] = np.genfromtxt(chunk, delimiter=',', usecols=use_cols, ndmin=2)
+                row += len(chunk)
+
+        sessions.append({"subject": subject, "session": session, "file": os.path.basename(file_name),
+                         "start": start, "stop": row})
+        if row - start != n_file_rows:
+            raise ValueError("%s changed while being read." % file_name)
+
+    data.flush()
+    del data
+    index = {"labels": labels, "sessions": sessions}
+    with open(os.path.join(store_dir, "index.json"), "w") as index_file:
+        json.dump(index, index_file, indent=1)
+    return SteamVRStore(store_dir)
+
+
+class SteamVRStore:
+    """
+    Read only, memory mapped store of SteamVR recordings, written by ingest_steamvr_csv.
+
+    data is the memory map of all the rows. sessions lists the subject, session, file name and rows (start, stop) of
+    every recording, and subjects maps every subject to its rows.
+    """
+
+    def __init__(self, store_dir):
+        """
+        Opens a store.
+        :param store_dir: Directory the store was written to.
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "index.json")) as index_file:
+            index = json.load(index_file)
+        self.labels = index["labels"]
+        self.sessions = index["sessions"]
+        self.data = np.load(os.path.join(store_dir, "data.npy"), mmap_mode='r')
+        self.column_index = {label: i for i, label in enumerate(self.labels)}
+
+        self.subjects = {}
+        for session in self.sessions:
+            start, stop = self.subjects.get(session["subject"], (session["start"], session["stop"]))
+            self.subjects[session["subject"]] = (min(start, session["start"]), max(stop, session["stop"]))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def rows(self, subject=None, session=None):
+        """
+        :param subject: Name of a subject, None for all of them.
+        :param session: Name of a session of the subject (e.g. 2017-04-28_01-36-18-PM), None for all of them.
+        :return: The slice of the rows of the subject or session.
+        """
+        if subject is None:
+            return slice(0, len(self))
+        if subject not in self.subjects:
+            raise KeyError("No subject %s in the store." % subject)
+        if session is None:
+            return slice(*self.subjects[subject])
+        for recording in self.sessions:
+            if recording["subject"] == subject and recording["session"] == session:
+                return slice(recording["start"], recording["stop"])
+        raise KeyError("No session %s for subject %s in the store." % (session, subject))
+
+    def get(self, labels=None, subject=None, session=None):
+        """
+        Gets columns of the rows of a subject or session.
+
+        :param labels: Labels of the columns, in any order, None for all of them.
+        :param subject: Name of a subject, None for all of them.
+        :param session: Name of a session of the subject, None for all of them.
+        :return: Array of shape (n_rows, n_labels). It is a view of the memory map if the labels are consecutive
+        columns of the store (e.g. the labels of a few groups in the order of POSITION_GROUPS), a copy otherwise.
+        """
+        rows = self.rows(subject, session)
+        if labels is None:
+            return self.data[rows]
+        columns = [self.column_index[label] for label in labels]
+        if columns == list(range(columns[0], columns[0] + len(columns))):
+            return self.data[rows, columns[0]:columns[0] + len(columns)]
+        return self.data[rows][:, columns]
+
+    def group(self, group, quaternion=False, subject=None, session=None):
+        """
+        Gets the positions or quaternions of a tracked device or body target, without any copy.
+
+        :param group: Name of the device or target, e.g. LController.
+        :param quaternion: if True, the quaternions (X, Y, Z, W) instead of the positions.
+        :param subject: Name of a subject, None for all of them.
+        :param session: Name of a session of the subject, None for all of them.
+        :return: Array of shape (n_rows, 3), or (n_rows, 4) for quaternions.
+        """
+        return self.get(group_labels(group, quaternion), subject, session)